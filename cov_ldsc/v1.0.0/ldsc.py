@@ -11,11 +11,13 @@ import ldscore.ldscore as ld
 import ldscore.parse as ps
 import ldscore.sumstats as sumstats
 import ldscore.regressions as reg
+import ldscore.parallel as parallel
 import numpy as np
 import pandas as pd
-from subprocess import call
+from scipy import sparse
 from itertools import product
-import time, sys, traceback, argparse
+import time, sys, os, traceback, argparse, copy
+import gzip, zlib, struct
 
 
 try:
@@ -82,6 +84,80 @@ class Logger(object):
         print msg
 
 
+class BGZFWriter(object):
+    '''
+    Minimal writer for block gzip (BGZF) files, which can be read by any gzip reader and
+    indexed with tabix. Data are compressed in independent blocks of at most 64KB.
+
+    '''
+    _BLOCK = 65280  # max uncompressed bytes per block, as in htslib
+    _EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+    def __init__(self, fname, level=6):
+        self.fh = open(fname, 'wb')
+        self.level = level
+        self.buf = []
+        self.buf_len = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self._BLOCK:
+            data = ''.join(self.buf)
+            n = len(data) - len(data) % self._BLOCK
+            for i in xrange(0, n, self._BLOCK):
+                self.__write_block__(data[i:i+self._BLOCK])
+
+            self.buf, self.buf_len = [data[n:]], len(data) - n
+
+    def __write_block__(self, data):
+        c = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = c.compress(data) + c.flush()
+        header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+            len(cdata) + 25)
+        self.fh.write(header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+            len(data)))
+
+    def close(self):
+        if self.buf_len > 0:
+            self.__write_block__(''.join(self.buf))
+            self.buf, self.buf_len = [], 0
+
+        self.fh.write(self._EOF)
+        self.fh.close()
+
+
+def _table_chunks(info, x, columns, rows=None, chunksize=100000):
+    '''
+    Yields the table of the SNP info (a DataFrame) and the values x (an array or sparse
+    matrix with one row per SNP and column names columns) chunksize rows at a time, only for the rows with indices rows if
+    rows is not None, so that the full table is never built.
+
+    '''
+    n = len(info) if rows is None else len(rows)
+    for i in xrange(0, max(n, 1), chunksize):
+        ii = slice(i, i+chunksize) if rows is None else rows[i:i+chunksize]
+        y = x[ii].toarray() if sparse.issparse(x) else np.asarray(x[ii])
+        yield pd.concat([info.iloc[ii].reset_index(drop=True),
+            pd.DataFrame(y, columns=columns)], axis=1)
+
+
+def _write_table(fname, chunks, bgzip=False, **kwargs):
+    '''
+    Writes the DataFrames chunks (e.g., from _table_chunks) one after the other as a gzip
+    (or BGZF if bgzip) compressed tab-delimited file, with the header of the first.
+    kwargs are passed to DataFrame.to_csv.
+
+    '''
+    f = BGZFWriter(fname) if bgzip else gzip.open(fname, 'wb')
+    try:
+        for i, df in enumerate(chunks):
+            f.write(df.to_csv(None, sep='\t', header=(i == 0), index=False, **kwargs))
+    finally:
+        f.close()
+
+
 def __filter__(fname, noun, verb, merge_obj):
     merged_list = None
     if fname:
@@ -100,21 +176,56 @@ def __filter__(fname, noun, verb, merge_obj):
 
         return merged_list
 
-def annot_sort_key(s):
-    '''For use with --cts-bin. Fixes weird pandas crosstab column order.'''
-    if type(s) == tuple:
-        s = [x.split('_')[0] for x in s]
-        s = map(lambda x: float(x) if x != 'min' else -float('inf'), s)
-    else:  # type(s) = str:
-        s = s.split('_')[0]
-        if s == 'min':
-            s = float('-inf')
-        else:
-            s = float(s)
+def _read_cov(fh):
+    '''Read --cov. Rows are indexed by the individual ID in the second column.'''
+    cov_matrix = pd.read_csv(fh, delim_whitespace=True, header=None)
+    cov_matrix.set_index(cov_matrix.iloc[:,1], inplace=True)
+    return cov_matrix
 
-    return s
 
-def ldscore(args, log):
+_ANNOT_SUFFIXES = ('.annot.gz', '.annot.bz2', '.annot')
+
+
+def _annot_sets(fh, chr=None):
+    '''
+    Parse --annot into a list of (name, filename). --annot is either one .annot file, a
+    comma-separated list of .annot files or a directory of .annot files. name is the file
+    name without the directory and the .annot[.gz|.bz2] suffix. If chr is not None (with
+    --bfile-chr), a trailing .<chr> is removed from name, and only the files of a directory
+    named <name>.<chr>.annot[.gz|.bz2] are used.
+
+    '''
+    if os.path.isdir(fh):
+        fnames = sorted(os.path.join(fh, x) for x in os.listdir(fh)
+            if x.endswith(_ANNOT_SUFFIXES))
+    else:
+        fnames = sumstats._splitp(fh)
+
+    sets = []
+    for fname in fnames:
+        name = os.path.basename(fname)
+        for suffix in _ANNOT_SUFFIXES:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+
+        if chr is not None:
+            if name.endswith('.' + str(chr)):
+                name = name[:-len(str(chr)) - 1]
+            elif os.path.isdir(fh):  # file for another chromosome
+                continue
+
+        sets.append((name, fname))
+
+    if len(sets) == 0:
+        raise ValueError('No .annot files found in {F}.'.format(F=fh))
+    if len(set(x[0] for x in sets)) != len(sets):
+        raise ValueError('The names of the annotation sets in --annot must be unique.')
+
+    return sets
+
+
+def ldscore(args, log, preloaded=None):
     '''
     Wrapper function for estimating l1, l1^2, l2 and l4 (+ optionally standard errors) from
     reference panel genotypes.
@@ -122,7 +233,18 @@ def ldscore(args, log):
     Annot format is
     chr snp bp cm <annotations>
 
+    If --annot lists several annotation sets (or is a directory), the LD Scores of all sets
+    are computed in one pass over the genotypes and each set is written to its own
+    <out>.<name>.l2.ldscore.gz, .M and .M_5_50 files.
+
+    preloaded is an optional dict of inputs that the caller has already parsed (used by
+    --bfile-chr so that each chromosome does not re-read them): 'cov' is the output of
+    _read_cov, 'annot' maps genome-wide --annot filenames to their .annot DataFrames
+    restricted to this chromosome and 'chr' is the chromosome number.
+
     '''
+    if preloaded is None:
+        preloaded = {}
 
     if args.bfile:
         snp_file, snp_obj = args.bfile+'.bim', ps.PlinkBIMFile
@@ -133,30 +255,43 @@ def ldscore(args, log):
     array_snps = snp_obj(snp_file)
     m = len(array_snps.IDList)
     log.log('Read list of {m} SNPs from {f}'.format(m=m, f=snp_file))
+    annot_sets = None
     if args.annot is not None:  # read --annot
-        try:
-            if args.thin_annot: # annot file has only annotations
-                annot = ps.ThinAnnotFile(args.annot)
-                n_annot, ma = len(annot.df.columns), len(annot.df)
-                log.log("Read {A} annotations for {M} SNPs from {f}".format(f=args.annot,
-                    A=n_annot, M=ma))
-                annot_matrix = annot.df.values
-                annot_colnames = annot.df.columns
-                keep_snps = None
-            else:
-                annot = ps.AnnotFile(args.annot)
-                n_annot, ma = len(annot.df.columns) - 4, len(annot.df)
-                log.log("Read {A} annotations for {M} SNPs from {f}".format(f=args.annot,
-                    A=n_annot, M=ma))
-                annot_matrix = np.array(annot.df.iloc[:,4:])
-                annot_colnames = annot.df.columns[4:]
-                keep_snps = None
-                if np.any(annot.df.SNP.values != array_snps.df.SNP.values):
-                    raise ValueError('The .annot file must contain the same SNPs in the same'+\
-                        ' order as the .bim file.')
-        except Exception:
-            log.log('Error parsing .annot file')
-            raise
+        annot_sets = _annot_sets(args.annot, preloaded.get('chr'))
+        annot_matrix, annot_colnames, set_sizes = [], [], []
+        for name, fh in annot_sets:
+            try:
+                if args.thin_annot: # annot file has only annotations
+                    annot = ps.ThinAnnotFile(fh)
+                    n_annot, ma = len(annot.df.columns), len(annot.df)
+                    log.log("Read {A} annotations for {M} SNPs from {f}".format(f=fh,
+                        A=n_annot, M=ma))
+                    annot_matrix.append(annot.df.values)
+                    annot_colnames.extend(annot.df.columns)
+                else:
+                    if fh in preloaded.get('annot', {}):
+                        annot_df = preloaded['annot'][fh]
+                    else:
+                        annot_df = ps.AnnotFile(fh).df
+                    n_annot, ma = len(annot_df.columns) - 4, len(annot_df)
+                    log.log("Read {A} annotations for {M} SNPs from {f}".format(f=fh,
+                        A=n_annot, M=ma))
+                    annot_matrix.append(np.array(annot_df.iloc[:,4:]))
+                    annot_colnames.extend(annot_df.columns[4:])
+                    if len(annot_df) != len(array_snps.df) or \
+                            np.any(annot_df.SNP.values != array_snps.df.SNP.values):
+                        raise ValueError('The .annot file must contain the same SNPs in the '+\
+                            'same order as the .bim file.')
+            except Exception:
+                log.log('Error parsing .annot file')
+                raise
+
+            set_sizes.append((n_annot, annot_matrix[-1].dtype))
+
+        # all annotation sets share one pass over the genotypes
+        annot_matrix = np.hstack(annot_matrix)
+        n_annot = len(annot_colnames)
+        keep_snps = None
 
     elif args.extract is not None:  # --extract
         keep_snps = __filter__(args.extract, 'SNPs', 'include', array_snps)
@@ -186,7 +321,7 @@ def ldscore(args, log):
 
         log.log('Reading numbers with which to bin SNPs from {F}'.format(F=args.cts_bin))
 
-        cts_levs = []
+        cts_bins = []
         full_labs = []
         for i,fh in enumerate(cts_fnames):
             vec = ps.read_cts(cts_fnames[i], array_snps.df.SNP.values)
@@ -214,36 +349,23 @@ def ldscore(args, log):
             name_breaks[-1] = 'max'
             name_breaks = [str(x) for x in name_breaks]
             labs = [name_breaks[i]+'_'+name_breaks[i+1] for i in xrange(n_breaks-1)]
-            cut_vec = pd.Series(pd.cut(vec, bins=cut_breaks, labels=labs))
-            cts_levs.append(cut_vec)
+            # bin j is (cut_breaks[j], cut_breaks[j+1]], as with pd.cut
+            cts_bins.append(np.digitize(vec, cut_breaks, right=True) - 1)
             full_labs.append(labs)
 
-        annot_matrix = pd.concat(cts_levs, axis=1)
-        annot_matrix.columns = cts_colnames
-        # crosstab -- for now we keep empty columns
-        annot_matrix = pd.crosstab(annot_matrix.index,
-            [annot_matrix[i] for i in annot_matrix.columns], dropna=False,
-            colnames=annot_matrix.columns)
-
-        # add missing columns
-        if len(cts_colnames) > 1:
-            for x in product(*full_labs):
-                if x not in annot_matrix.columns:
-                    annot_matrix[x] = 0
-        else:
-            for x in full_labs[0]:
-                if x not in annot_matrix.columns:
-                    annot_matrix[x] = 0
-
-        annot_matrix = annot_matrix[sorted(annot_matrix.columns, key=annot_sort_key)]
+        # one indicator column per combination of bins (empty columns are kept), in the
+        # order of product(*full_labs)
+        dims = [len(labs) for labs in full_labs]
+        binned = np.all([(x >= 0) & (x < d) for x, d in zip(cts_bins, dims)], axis=0)
+        cols = np.ravel_multi_index([np.where(binned, x, 0) for x in cts_bins], dims)
+        annot_matrix = sparse.csr_matrix((binned.astype('int64'), (np.arange(len(cols)),
+            cols)), shape=(len(cols), np.prod(dims)))
         if len(cts_colnames) > 1:
-            # flatten multi-index
             annot_colnames = ['_'.join([cts_colnames[i]+'_'+b for i,b in enumerate(c)])
-                for c in annot_matrix.columns]
+                for c in product(*full_labs)]
         else:
-            annot_colnames = [cts_colnames[0]+'_'+b for b in annot_matrix.columns]
+            annot_colnames = [cts_colnames[0]+'_'+b for b in full_labs[0]]
 
-        annot_matrix = np.matrix(annot_matrix)
         keep_snps = None
         n_annot = len(annot_colnames)
         if np.any(np.sum(annot_matrix, axis=1) == 0):
@@ -273,15 +395,30 @@ def ldscore(args, log):
     geno_array = array_obj(array_file, n, array_snps, keep_snps=keep_snps,
         keep_indivs=keep_indivs, mafMin=args.maf)
 
+    # print per-SNP QC table computed by the MAF filter
+    if args.print_snp_qc:
+        out_fname_qc = args.out + '.snpqc'
+        qc_df = array_snps.df.iloc[geno_array.qc_snps][['CHR', 'SNP', 'BP']]
+        qc_df['CALL_RATE'] = geno_array.call_rate
+        qc_df['HET_CT'] = geno_array.het_ct
+        qc_df['KEPT'] = np.in1d(geno_array.qc_snps, geno_array.kept_snps).astype(int)
+        log.log('Writing per-SNP QC table for {N} SNPs to {F}'.format(N=len(qc_df),
+            F=out_fname_qc))
+        qc_df.to_csv(out_fname_qc, sep="\t", header=True, index=False, float_format='%.4f')
+
     # read covariance file 
     if args.cov is not None:
-    	global cov_matrix
-        cov_matrix=pd.read_csv(args.cov, delim_whitespace=True, header=None) 
-        cov_matrix.set_index(cov_matrix.iloc[:,1],inplace=True)
+        if 'cov' in preloaded:
+            cov_matrix = preloaded['cov']
+        else:
+            cov_matrix = _read_cov(args.cov)
         cov_matrix=cov_matrix.loc[array_indivs.IDList.iloc[:,0],:]
+        # keep only the covariate columns, as one contiguous array, so that each window of
+        # SNPs is residualized with a single matrix product
+        cov_matrix = np.ascontiguousarray(cov_matrix.iloc[:,2:], dtype='float64')
 
     else:
-    	cov_matrix=None
+        cov_matrix=None
 
 
     # filter annot_matrix down to only SNPs passing MAF cutoffs
@@ -320,13 +457,73 @@ def ldscore(args, log):
         pq = np.matrix(geno_array.maf*(1-geno_array.maf)).reshape((geno_array.m, 1))
         pq = np.power(pq, args.pq_exp)
 
-        if annot_matrix is not None:
+        if sparse.issparse(annot_matrix):
+            annot_matrix = sparse.csr_matrix(annot_matrix.multiply(pq))
+        elif annot_matrix is not None:
             annot_matrix = np.multiply(annot_matrix, pq)
         else:
             annot_matrix = pq
 
+    if args.geno_cache is not None:
+        t = time.time()
+        hit = geno_array.useGenotypeCache(args.geno_cache, cov=cov_matrix,
+            dtype=np.dtype(args.precision), max_bytes=args.geno_cache_size*1e9)
+        log.log('{A} standardized genotypes {P} the cache in {D} ({T})'.format(
+            A='Read' if hit else 'Wrote', P='from' if hit else 'to', D=args.geno_cache,
+            T=sec_to_str(round(time.time() - t, 2))))
+
     log.log("Estimating LD Score.")
-    lN = geno_array.ldScoreVarBlocks(block_left, args.chunk_size, annot=annot_matrix, cov=cov_matrix)
+    if args.n_workers > 1:
+        log.log('Splitting the chromosome into {W} segments.'.format(W=args.n_workers))
+    if args.precision != 'float64':
+        log.log('Computing correlations in {P}.'.format(P=args.precision))
+    annot_ld = annot_matrix
+    if annot_matrix is not None:
+        if sparse.issparse(annot_matrix):  # --cts-bin
+            density = annot_matrix.count_nonzero() / np.prod(annot_matrix.shape)
+        else:
+            density = np.mean(annot_matrix != 0)
+        if density < 0.5:
+            # mostly-zero annotations (e.g., pathways, --cts-bin): only multiply by the
+            # annotations that are non-zero in each window
+            log.log('Using sparse annotations ({D:.1%} non-zero).'.format(D=density))
+            annot_ld = sparse.csr_matrix(annot_matrix)
+        elif sparse.issparse(annot_matrix):
+            annot_ld = annot_matrix.toarray()
+    checkpoint = None
+    if args.checkpoint_interval is not None or args.resume:
+        checkpoint = args.out + '.l2.ckpt.npz'
+        if args.resume and os.path.exists(checkpoint):
+            log.log('Resuming from checkpoint {F}'.format(F=checkpoint))
+        elif args.checkpoint_interval is not None:
+            log.log('Writing a checkpoint to {F} every {T} seconds'.format(F=checkpoint,
+                T=args.checkpoint_interval))
+    lN = geno_array.ldScoreVarBlocks(block_left, args.chunk_size, annot=annot_ld,
+        cov=cov_matrix, n_workers=args.n_workers, dtype=np.dtype(args.precision),
+        checkpoint=checkpoint, resume=args.resume,
+        checkpoint_interval=(float('inf') if args.checkpoint_interval is None
+            else args.checkpoint_interval))
+    if annot_sets is not None and (len(annot_sets) > 1 or os.path.isdir(args.annot)):
+        j = 0
+        for (name, fh), (k, dtype) in zip(annot_sets, set_sizes):
+            log.log('\nAnnotation set {S} ({F})'.format(S=name, F=fh))
+            x = annot_matrix[:, j:j+k]
+            if args.pq_exp is None:  # undo the upcast of np.hstack (e.g., for .M)
+                x = x.astype(dtype)
+            _print_ldscore(args, log, args.out + '.' + name, geno_array, lN[:, j:j+k], x,
+                annot_colnames[j:j+k], k, scale_suffix)
+            j += k
+    else:
+        _print_ldscore(args, log, args.out, geno_array, lN, annot_matrix, annot_colnames,
+            n_annot, scale_suffix)
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+def _print_ldscore(args, log, out, geno_array, lN, annot_matrix, annot_colnames, n_annot,
+                   scale_suffix):
+    '''Write the LD Scores lN (and .M, .M_5_50) of one annotation set to out and log a summary.'''
     col_prefix = "L2"; file_suffix = "l2"
 
     if n_annot == 1:
@@ -335,10 +532,9 @@ def ldscore(args, log):
         ldscore_colnames =  [y+col_prefix+scale_suffix for y in annot_colnames]
 
     # print .ldscore. Output columns: CHR, BP, RS, [LD Scores]
-    out_fname = args.out + '.' + file_suffix + '.ldscore'
-    new_colnames = geno_array.colnames + ldscore_colnames
-    df = pd.DataFrame.from_records(np.c_[geno_array.df, lN])
-    df.columns = new_colnames
+    out_fname = out + '.' + file_suffix + '.ldscore'
+    info = pd.DataFrame(geno_array.df, columns=geno_array.colnames).infer_objects()
+    rows = None
     if args.print_snps:
         if args.print_snps.endswith('gz'):
             print_snps = pd.read_csv(args.print_snps, header=None, compression='gzip')
@@ -352,18 +548,24 @@ def ldscore(args, log):
                         F=args.print_snps, N=len(print_snps)))
 
         print_snps.columns=['SNP']
-        df = df.ix[df.SNP.isin(print_snps.SNP),:]
-        if len(df) == 0:
+        rows = np.flatnonzero(info.SNP.isin(print_snps.SNP))
+        if len(rows) == 0:
             raise ValueError('After merging with --print-snps, no SNPs remain.')
         else:
             msg = 'After merging with --print-snps, LD Scores for {N} SNPs will be printed.'
-            log.log(msg.format(N=len(df)))
+            log.log(msg.format(N=len(rows)))
 
+    # the table is written in chunks of rows of info and lN, rather than as one DataFrame
+    n_print = len(info) if rows is None else len(rows)
+    l2_info = info[['CHR', 'SNP', 'BP']]
     l2_suffix = '.gz'
-    log.log("Writing LD Scores for {N} SNPs to {f}.gz".format(f=out_fname, N=len(df)))
-    df.drop(['CM','MAF'], axis=1).to_csv(out_fname, sep="\t", header=True, index=False,
-        float_format='%.3f')
-    call(['gzip', '-f', out_fname])
+    log.log("Writing LD Scores for {N} SNPs to {f}.gz".format(f=out_fname, N=n_print))
+    _write_table(out_fname + l2_suffix, _table_chunks(l2_info, lN, ldscore_colnames, rows),
+        bgzip=args.bgzip, float_format='%.3f')
+    if args.columnar:
+        log.log("Writing binary columnar LD Scores to {f}.cols".format(f=out_fname))
+        ps.write_l2_cols(out_fname + '.cols', _table_chunks(l2_info, lN, ldscore_colnames,
+            rows), n_print)
     if annot_matrix is not None:
         M = np.atleast_1d(np.squeeze(np.asarray(np.sum(annot_matrix, axis=0))))
         ii = geno_array.maf > 0.05
@@ -373,65 +575,166 @@ def ldscore(args, log):
         M_5_50 = [np.sum(geno_array.maf > 0.05)]
 
     # print .M
-    fout_M = open(args.out + '.'+ file_suffix +'.M','wb')
+    fout_M = open(out + '.'+ file_suffix +'.M','wb')
     print >>fout_M, '\t'.join(map(str,M))
     fout_M.close()
 
     # print .M_5_50
-    fout_M_5_50 = open(args.out + '.'+ file_suffix +'.M_5_50','wb')
+    fout_M_5_50 = open(out + '.'+ file_suffix +'.M_5_50','wb')
     print >>fout_M_5_50, '\t'.join(map(str,M_5_50))
     fout_M_5_50.close()
 
     # print annot matrix
     if (args.cts_bin is not None) and not args.no_print_annot:
-        out_fname_annot = args.out + '.annot'
-        new_colnames = geno_array.colnames + ldscore_colnames
-        annot_df = pd.DataFrame(np.c_[geno_array.df, annot_matrix])
-        annot_df.columns = new_colnames
-        del annot_df['MAF']
+        out_fname_annot = out + '.annot.gz'
         log.log("Writing annot matrix produced by --cts-bin to {F}".format(F=out_fname+'.gz'))
-        annot_df.to_csv(out_fname_annot, sep="\t", header=True, index=False)
-        call(['gzip', '-f', out_fname_annot])
+        _write_table(out_fname_annot, _table_chunks(info.drop('MAF', axis=1), annot_matrix,
+            ldscore_colnames), bgzip=args.bgzip)
 
-    # print LD Score summary
+    # print LD Score summary (of the sample MAF and the LD Scores of the printed SNPs)
+    stats = pd.DataFrame(lN if rows is None else lN[rows], columns=ldscore_colnames)
+    stats.insert(0, 'MAF', info.MAF.values if rows is None else info.MAF.values[rows])
     pd.set_option('display.max_rows', 200)
     log.log('\nSummary of LD Scores in {F}'.format(F=out_fname+l2_suffix))
-    t = df.ix[:,4:].describe()
+    t = stats.describe()
     log.log( t.ix[1:,:] )
 
     np.seterr(divide='ignore', invalid='ignore')  # print NaN instead of weird errors
     # print correlation matrix including all LD Scores and sample MAF
     log.log('')
     log.log('MAF/LD Score Correlation Matrix')
-    log.log( df.ix[:,4:].corr() )
+    log.log( stats.corr() )
 
     # print condition number
     if n_annot > 1: # condition number of a column vector w/ nonzero var is trivially one
         log.log('\nLD Score Matrix Condition Number')
-        cond_num = np.linalg.cond(df.ix[:,5:])
+        cond_num = np.linalg.cond(stats.ix[:,1:])
         log.log( reg.remove_brackets(str(np.matrix(cond_num))) )
         if cond_num > 10000:
             log.log('WARNING: ill-conditioned LD Score Matrix!')
 
     # summarize annot matrix if there is one
     if annot_matrix is not None:
+        if sparse.issparse(annot_matrix):  # --cts-bin: from A'A, without densifying A
+            n = annot_matrix.shape[0]
+            col_sums = np.asarray(annot_matrix.sum(axis=0)).ravel()
+            cov = annot_matrix.T.dot(annot_matrix).toarray() - np.outer(col_sums, col_sums)/n
+            sd = np.sqrt(np.diag(cov))
+            corr = pd.DataFrame(cov / np.outer(sd, sd), index=annot_colnames,
+                columns=annot_colnames)
+            col_sums = pd.Series(col_sums, index=annot_colnames)
+            row_sums = pd.Series(np.asarray(annot_matrix.sum(axis=1)).ravel())
+        else:
+            x = pd.DataFrame(annot_matrix, columns=annot_colnames)
+            corr, col_sums, row_sums = x.corr(), x.sum(axis=0), x.sum(axis=1)
+
         # covariance matrix
-        x = pd.DataFrame(annot_matrix, columns=annot_colnames)
         log.log('\nAnnotation Correlation Matrix')
-        log.log( x.corr() )
+        log.log( corr )
 
         # column sums
         log.log('\nAnnotation Matrix Column Sums')
-        log.log(_remove_dtype(x.sum(axis=0)))
+        log.log(_remove_dtype(col_sums))
 
         # row sums
         log.log('\nSummary of Annotation Matrix Row Sums')
-        row_sums = x.sum(axis=1).describe()
-        log.log(_remove_dtype(row_sums))
+        log.log(_remove_dtype(row_sums.describe()))
 
     np.seterr(divide='raise', invalid='raise')
 
 
+def _ldscore_chr_worker(job):
+    '''Run ldscore() for one chromosome of --bfile-chr. Returns (chr, status, seconds).'''
+    chr, args = job
+    start_time = time.time()
+    log = Logger(args.out + '.log')
+    shared, preloaded = parallel.state(), {}
+    if 'cov' in shared:
+        preloaded['cov'] = shared['cov']
+    if 'annot' in shared:
+        preloaded['annot'] = {fh: x.get(chr, empty)
+            for fh, (x, empty) in shared['annot'].items()}
+    preloaded['chr'] = chr
+
+    try:
+        log.log('Chromosome {C}: --bfile {F}'.format(C=chr, F=args.bfile))
+        ldscore(args, log, preloaded=preloaded)
+        status = 'OK'
+    except Exception:
+        log.log(traceback.format_exc())
+        status = 'FAILED'
+
+    time_elapsed = round(time.time()-start_time, 2)
+    log.log('Chromosome {C} finished in {T}'.format(C=chr, T=sec_to_str(time_elapsed)))
+    return (chr, status, time_elapsed)
+
+
+def ldscore_chr(args, log):
+    '''
+    Estimate LD Scores for each of the 22 chromosomes of --bfile-chr, sharding the
+    chromosomes across --n-workers processes. Each chromosome is written to its own
+    .l2.ldscore.gz, .M and .M_5_50 files (and .log), with @ in --out (or the end of
+    --out) replaced by the chromosome number, as read by --ref-ld-chr.
+
+    --cov and genome-wide --annot files are parsed once and shared with the workers. Any
+    of --annot, --cts-bin, --extract and --print-snps that contains @ is read per
+    chromosome, as are the <name>.<chr>.annot[.gz|.bz2] files of an --annot directory.
+
+    '''
+    shared = {}  # inputs parsed once and shared with the workers
+    if args.cov is not None:
+        log.log('Reading covariates from {F}'.format(F=args.cov))
+        shared['cov'] = _read_cov(args.cov)
+
+    if args.annot is not None and not os.path.isdir(args.annot):
+        shared['annot'] = {}
+        for name, fh in _annot_sets(args.annot):
+            if '@' in fh:
+                continue
+            if args.thin_annot:
+                raise ValueError('--thin-annot with --bfile-chr requires one --annot file '
+                    'per chromosome (use @ in --annot).')
+            annot_df = ps.AnnotFile(fh).df
+            log.log('Read {A} annotations for {M} SNPs from {F}'.format(F=fh,
+                A=len(annot_df.columns) - 4, M=len(annot_df)))
+            shared['annot'][fh] = ({c: x.reset_index(drop=True)
+                for c, x in annot_df.groupby('CHR')}, annot_df.iloc[0:0])
+
+    jobs = []
+    for chr in xrange(1, sumstats._N_CHR + 1):
+        args_chr = copy.deepcopy(args)
+        args_chr.bfile = ps.sub_chr(args.bfile_chr, chr)
+        args_chr.bfile_chr = None
+        args_chr.out = ps.sub_chr(args.out, chr)
+        args_chr.n_workers = 1  # the workers of a Pool cannot start their own
+        for attr in ('annot', 'cts_bin', 'extract', 'print_snps'):
+            fh = getattr(args, attr)
+            if fh is not None and '@' in fh:
+                setattr(args_chr, attr, ps.sub_chr(fh, chr))
+
+        jobs.append((chr, args_chr))
+
+    f = ps.sub_chr(args.bfile_chr, '[1-{N}]'.format(N=sumstats._N_CHR))
+    log.log('Estimating LD Scores for {N} chromosomes from {F} with {W} worker(s).'.format(
+        N=len(jobs), F=f, W=args.n_workers))
+    results = parallel.fork_map(_ldscore_chr_worker, jobs, args.n_workers, shared,
+                                ordered=False)
+    report = []
+    for (chr, status, time_elapsed) in results:
+        report.append((chr, status, time_elapsed))
+        log.log('Chromosome {C}: {S} in {T} ({I}/{N} done)'.format(C=chr, S=status,
+            T=sec_to_str(time_elapsed), I=len(report), N=len(jobs)))
+
+    report = pd.DataFrame(sorted(report), columns=['CHR', 'STATUS', 'SECONDS'])
+    log.log('\nSummary of LD Score estimation by chromosome')
+    log.log(report.to_string(index=False))
+    log.log('Sum of per-chromosome times: {T}'.format(T=sec_to_str(report.SECONDS.sum())))
+    failed = report.CHR[report.STATUS != 'OK']
+    if len(failed) > 0:
+        raise ValueError('LD Score estimation failed for chromosome(s) {C}. See the '
+            'per-chromosome .log files.'.format(C=', '.join(map(str, failed))))
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--out', default='ldsc', type=str,
     help='Output filename prefix. If --out is not set, LDSC will use ldsc as the '
@@ -439,6 +742,15 @@ parser.add_argument('--out', default='ldsc', type=str,
 # Basic LD Score Estimation Flags'
 parser.add_argument('--bfile', default=None, type=str,
     help='Prefix for Plink .bed/.bim/.fam file')
+parser.add_argument('--bfile-chr', default=None, type=str,
+    help='Same as --bfile, but estimates LD Scores for each of the 22 chromosomes, with @ '
+    'in the prefix (or the end of the prefix) replaced by the chromosome number. Output '
+    'is written to one set of files per chromosome in the same way.')
+parser.add_argument('--n-workers', default=1, type=int,
+    help='Number of processes used to estimate LD Scores. With --bfile, the chromosome is '
+    'split into this many segments of SNPs, which are computed in parallel and stitched '
+    'back together. With --bfile-chr, the chromosomes are computed in parallel. With '
+    '--h2-cts, the regressions of the cell types are run in parallel.')
 parser.add_argument('--l2', default=False, action='store_true',
     help='Estimate l2. Compatible with both jackknife and non-jackknife.')
 # Filtering / Data Management for LD Score
@@ -466,7 +778,11 @@ parser.add_argument('--print-snps', default=None, type=str,
 parser.add_argument('--annot', default=None, type=str,
     help='Filename prefix for annotation file for partitioned LD Score estimation. '
     'LDSC will automatically append .annot or .annot.gz to the filename prefix. '
-    'See docs/file_formats_ld for a definition of the .annot format.')
+    'See docs/file_formats_ld for a definition of the .annot format. A comma-separated '
+    'list of .annot files or a directory of .annot files computes the LD Scores of all '
+    'of these annotation sets in one pass over the genotypes, and writes each set NAME '
+    '(the file name without .annot[.gz|.bz2]) to --out.NAME.l2.ldscore.gz. With '
+    '--bfile-chr, the files in the directory must be named NAME.<chr>.annot[.gz|.bz2].')
 parser.add_argument('--thin-annot', action='store_true', default=False,
     help='This flag says your annot files have only annotations, with no SNP, CM, CHR, BP columns.')
 parser.add_argument('--cts-bin', default=None, type=str,
@@ -494,12 +810,22 @@ parser.add_argument('--pq-exp', default=None, type=float,
     help='Setting this flag causes LDSC to compute LD Scores with the given scale factor, '
     'i.e., \ell_j := \sum_k (p_k(1-p_k))^a r^2_{jk}, where p_k denotes the MAF '
     'of SNP j and a is the argument to --pq-exp. ')
+parser.add_argument('--bgzip', default=False, action='store_true',
+    help='Compress the .ldscore (and --cts-bin .annot) files with block gzip (BGZF), '
+    'so that they can be indexed with tabix, instead of plain gzip.')
+parser.add_argument('--columnar', default=False, action='store_true',
+    help='Also write the LD Scores in a binary columnar format (a directory '
+    '.l2.ldscore.cols next to the .l2.ldscore.gz file), which --h2, --rg and '
+    '--h2-cts memory-map instead of parsing the text file.')
 parser.add_argument('--no-print-annot', default=False, action='store_true',
     help='By defualt, seting --cts-bin or --cts-bin-add causes LDSC to print '
     'the resulting annot matrix. Setting --no-print-annot tells LDSC not '
     'to print the annot matrix. ')
 parser.add_argument('--maf', default=None, type=float,
     help='Minor allele frequency lower bound. Default is MAF > 0.')
+parser.add_argument('--print-snp-qc', default=False, action='store_true',
+    help='Print the call rate and het count of every SNP examined by the MAF filter '
+    'to a .snpqc file.')
 # Basic Flags for Working with Variance Components
 parser.add_argument('--h2', default=None, type=str,
     help='Filename for a .sumstats[.gz] file for one-phenotype LD Score regression. '
@@ -509,6 +835,18 @@ parser.add_argument('--h2-cts', default=None, type=str,
     '--h2-cts requires the --ref-ld-chr, --w-ld, and --ref-ld-chr-cts flags.')
 parser.add_argument('--rg', default=None, type=str,
     help='Comma-separated list of prefixes of .chisq filed for genetic correlation estimation.')
+parser.add_argument('--h2-batch', default=None, type=str,
+    help='File listing one .sumstats[.gz] file per line. Runs --h2 for each file, reading '
+    '--ref-ld, --w-ld and M only once, and prints a table of the results to out.h2_batch.txt. '
+    'The output of each file goes to out.<file name>.*.')
+parser.add_argument('--rg-batch', default=None, type=str,
+    help='File with one comma-separated list of .sumstats[.gz] files per line, as for --rg. '
+    'Runs --rg for each line, reading --ref-ld, --w-ld and M only once, and prints a table '
+    'of all pairs to out.rg_batch.txt.')
+parser.add_argument('--rg-matrix', default=None, type=str,
+    help='Comma-separated list of .sumstats[.gz] files. Estimates rg between every pair, '
+    'reading each file once and fitting h2 once per trait (and set of SNPs), with the fits '
+    'run in --n-workers processes. Prints the matrix of rg to out.rg_matrix.txt.')
 parser.add_argument('--ref-ld', default=None, type=str,
     help='Use --ref-ld to tell LDSC which LD Scores to use as the predictors in the LD '
     'Score regression. '
@@ -569,12 +907,36 @@ parser.add_argument('--print-delete-vals', default=False, action='store_true',
 # Flags you should almost never use
 parser.add_argument('--chunk-size', default=50, type=int,
     help='Chunk size for LD Score calculation. Use the default.')
+parser.add_argument('--geno-cache', default=None, type=str,
+    help='Directory of cached standardized (and --cov residualized) genotypes. The first '
+    'run with a given --bfile, --keep, --extract, --maf, --cov and --precision stores '
+    'its genotypes there; later runs (e.g., with other windows or annotations) read them '
+    'instead of decoding the .bed file again.')
+parser.add_argument('--geno-cache-size', default=50, type=float,
+    help='Maximum size of --geno-cache in GB. The least recently used genotypes are '
+    'deleted first.')
+parser.add_argument('--checkpoint-interval', default=None, type=float,
+    help='Write the state of the LD Score computation to --out.l2.ckpt.npz every this many '
+    'seconds (0: after every chunk), so that an interrupted run can be continued with '
+    '--resume. The checkpoint is removed once the LD Scores have been written.')
+parser.add_argument('--resume', default=False, action='store_true',
+    help='Continue the LD Score computation from --out.l2.ckpt.npz (if it exists) instead of '
+    'from the start. Use the same flags as the interrupted run; the output is identical to '
+    'an uninterrupted run.')
+parser.add_argument('--precision', default='float64', type=str,
+    choices=['float64', 'float32'],
+    help='Precision of the genotype matrices and correlations used to estimate LD Scores. '
+    'float32 roughly halves memory traffic; LD Scores are still summed in float64.')
 parser.add_argument('--pickle', default=False, action='store_true',
     help='Store .l2.ldscore files as pickles instead of gzipped tab-delimited text.')
 parser.add_argument('--yes-really', default=False, action='store_true',
     help='Yes, I really want to compute whole-chromosome LD Score.')
 parser.add_argument('--invert-anyway', default=False, action='store_true',
     help="Force LDSC to attempt to invert ill-conditioned matrices.")
+parser.add_argument('--read-threads', default=None, type=int,
+    help='Read the chromosome files of --ref-ld[-chr], --w-ld[-chr] and the .annot files '
+    'with this many threads, and the three inputs concurrently. Also logs how long each '
+    'file took to read. The files are concatenated in the same order as without this flag.')
 parser.add_argument('--n-blocks', default=200, type=int,
     help='Number of block jackknife blocks.')
 parser.add_argument('--not-M-5-50', default=False, action='store_true',
@@ -616,9 +978,19 @@ if __name__ == '__main__':
         start_time = time.time()
         if args.n_blocks <= 1:
             raise ValueError('--n-blocks must be an integer > 1.')
-        if args.bfile is not None:
+        if args.bfile is not None or args.bfile_chr is not None:
             if args.l2 is None:
                 raise ValueError('Must specify --l2 with --bfile.')
+            if args.bfile is not None and args.bfile_chr is not None:
+                raise ValueError('Cannot set both --bfile and --bfile-chr.')
+            if args.n_workers < 1:
+                raise ValueError('--n-workers must be an integer >= 1.')
+            if args.checkpoint_interval is not None and args.checkpoint_interval < 0:
+                raise ValueError('--checkpoint-interval must be >= 0.')
+            if args.bfile is not None and args.n_workers > 1 and \
+                    (args.checkpoint_interval is not None or args.resume):
+                raise ValueError('--checkpoint-interval and --resume require --n-workers 1 '
+                    'with --bfile.')
             if args.annot is not None and args.extract is not None:
                 raise ValueError('--annot and --extract are currently incompatible.')
             if args.cts_bin is not None and args.extract is not None:
@@ -633,17 +1005,30 @@ if __name__ == '__main__':
                 args.pq_exp = 1
 
 
-            ldscore(args, log)
+            if args.bfile_chr is not None:
+                ldscore_chr(args, log)
+            else:
+                ldscore(args, log)
         # summary statistics
-        elif (args.h2 or args.rg or args.h2_cts) and (args.ref_ld or args.ref_ld_chr) and (args.w_ld or args.w_ld_chr):
+        elif (args.h2 or args.rg or args.h2_cts or args.h2_batch or args.rg_batch or
+                args.rg_matrix) and \
+                (args.ref_ld or args.ref_ld_chr) and (args.w_ld or args.w_ld_chr):
             if args.h2 is not None and args.rg is not None:
                 raise ValueError('Cannot set both --h2 and --rg.')
+            if sum(x is not None for x in (args.h2, args.rg, args.h2_cts, args.h2_batch,
+                    args.rg_batch, args.rg_matrix)) > 1:
+                raise ValueError('Can only set one of --h2, --rg, --h2-cts, --h2-batch, '
+                    '--rg-batch and --rg-matrix.')
             if args.ref_ld and args.ref_ld_chr:
                 raise ValueError('Cannot set both --ref-ld and --ref-ld-chr.')
             if args.w_ld and args.w_ld_chr:
                 raise ValueError('Cannot set both --w-ld and --w-ld-chr.')
             if (args.samp_prev is not None) != (args.pop_prev is not None):
                 raise ValueError('Must set both or neither of --samp-prev and --pop-prev.')
+            if args.read_threads is not None and args.read_threads < 1:
+                raise ValueError('--read-threads must be an integer >= 1.')
+            if args.n_workers < 1:
+                raise ValueError('--n-workers must be an integer >= 1.')
 
             if not args.overlap_annot or args.not_M_5_50:
                 if args.frqfile is not None or args.frqfile_chr is not None:
@@ -660,6 +1045,12 @@ if __name__ == '__main__':
                 sumstats.estimate_h2(args, log)
             elif args.h2_cts:
                 sumstats.cell_type_specific(args, log)
+            elif args.h2_batch:
+                sumstats.estimate_h2_batch(args, log)
+            elif args.rg_batch:
+                sumstats.estimate_rg_batch(args, log)
+            elif args.rg_matrix:
+                sumstats.estimate_rg_matrix(args, log)
 
             # bad flags
         else:
@@ -13,8 +13,10 @@ of the data.
 '''
 
 from __future__ import division
+import time
 import numpy as np
 from scipy.optimize import nnls
+from scipy import linalg
 np.seterr(divide='raise', invalid='raise')
 
 
@@ -300,14 +302,30 @@ class LstsqJackknifeFast(Jackknife):
         Computes whole-data estimate from block values.
     block_values_to_pseudovalues(block_values, est) :
         Computes pseudovalues and delete values in a single pass over the block values.
+    rank_update_delete_values(x, y, s) :
+        Computes the estimate and delete values from one Cholesky factorization of X^T X.
+
+    If every block has fewer than p / 3 rows, the delete values are computed with
+    rank_update_delete_values, which costs O(n p^2) instead of the O(n_blocks p^3) of
+    solving each delete system.
 
     '''
 
     def __init__(self, x, y, n_blocks=None, separators=None):
         Jackknife.__init__(self, x, y, n_blocks, separators)
-        xty, xtx = self.block_values(x, y, self.separators)
-        self.est = self.block_values_to_est(xty, xtx)
-        self.delete_values = self.block_values_to_delete_values(xty, xtx)
+        self.est = None
+        if self.use_rank_update(self.separators, self.p):
+            try:
+                self.est, self.delete_values = self.rank_update_delete_values(
+                    x, y, self.separators)
+            except np.linalg.LinAlgError:  # X^T X not positive definite
+                pass
+
+        if self.est is None:
+            xty, xtx = self.block_values(x, y, self.separators)
+            self.est = self.block_values_to_est(xty, xtx)
+            self.delete_values = self.block_values_to_delete_values(xty, xtx)
+
         self.pseudovalues = self.delete_values_to_pseudovalues(
             self.delete_values, self.est)
         (self.jknife_est, self.jknife_var, self.jknife_se, self.jknife_cov) =\
@@ -343,14 +361,26 @@ class LstsqJackknifeFast(Jackknife):
 
         '''
         n, p = _check_shape(x, y)
+        x, y = np.asarray(x), np.asarray(y)
+        s = np.asarray(s, dtype=int)
         n_blocks = len(s) - 1
+        lens = np.diff(s)
         xtx_block_values = np.zeros((n_blocks, p, p))
         xty_block_values = np.zeros((n_blocks, p))
-        for i in xrange(n_blocks):
-            xty_block_values[i, ...] = np.dot(
-                x[s[i]:s[i + 1], ...].T, y[s[i]:s[i + 1], ...]).reshape((1, p))
-            xtx_block_values[i, ...] = np.dot(
-                x[s[i]:s[i + 1], ...].T, x[s[i]:s[i + 1], ...])
+        # stack the blocks of each length into (k, L, p) arrays and multiply each stack in
+        # one batched matmul (evenly-spaced separators give at most two lengths)
+        for L in np.unique(lens):
+            ii = np.nonzero(lens == L)[0]
+            if len(ii) == n_blocks:  # all blocks have the same length: no copy needed
+                xb = x[s[0]:s[-1]].reshape((n_blocks, L, p))
+                yb = y[s[0]:s[-1]].reshape((n_blocks, L, 1))
+            else:
+                rows = s[ii].reshape((len(ii), 1)) + np.arange(L)
+                xb, yb = x[rows], y[rows]
+
+            xbt = xb.transpose((0, 2, 1))
+            xty_block_values[ii] = np.matmul(xbt, yb)[:, :, 0]
+            xtx_block_values[ii] = np.matmul(xbt, xb)
 
         return (xty_block_values, xtx_block_values)
 
@@ -414,16 +444,71 @@ class LstsqJackknifeFast(Jackknife):
 
         '''
         n_blocks, p = _check_shape_block(xty_block_values, xtx_block_values)
-        delete_values = np.zeros((n_blocks, p))
         xty_tot = np.sum(xty_block_values, axis=0)
         xtx_tot = np.sum(xtx_block_values, axis=0)
-        for j in xrange(n_blocks):
-            delete_xty = xty_tot - xty_block_values[j]
-            delete_xtx = xtx_tot - xtx_block_values[j]
-            delete_values[j, ...] = np.linalg.solve(
-                delete_xtx, delete_xty).reshape((1, p))
+        delete_xty = xty_tot - xty_block_values
+        delete_xtx = xtx_tot - xtx_block_values
+        # one batched solve of the (n_blocks, p, p) stack of delete normal equations
+        return np.linalg.solve(delete_xtx, delete_xty[..., np.newaxis])[..., 0]
+
+
+    @classmethod
+    def use_rank_update(cls, s, p):
+        '''True if rank_update_delete_values is cheaper than block_values_to_delete_values.'''
+        return 3 * np.max(np.diff(s)) < p
 
-        return delete_values
+    @classmethod
+    def rank_update_delete_values(cls, x, y, s):
+        '''
+        Computes the whole-data estimate and the delete values with a single Cholesky
+        factorization of A = X^T X. Deleting block j (rows X_j, Y_j) is a rank-L_j downdate
+        of A, so by the Woodbury identity the delete value is
+
+            w_j + U_j (I - X_j U_j)^{-1} X_j w_j,
+
+        where U_j = A^{-1} X_j^T and w_j = est - U_j Y_j. The (L_j, L_j) systems of blocks
+        with the same length are solved in one batched np.linalg.solve.
+
+        Parameters
+        ----------
+        x : np.matrix with shape (n, p)
+            Independent variable.
+        y : np.matrix with shape (n, 1)
+            Dependent variable.
+        s : list of ints
+            Block separators.
+
+        Returns
+        -------
+        est : np.matrix with shape (1, p)
+            Whole data estimate.
+        delete_values : np.matrix with shape (n_blocks, p)
+            Delete Values.
+
+        Raises
+        ------
+        LinAlgError :
+            If X^T X is not positive definite or a delete design matrix is singular.
+
+        '''
+        n, p = _check_shape(x, y)
+        x, y = np.asarray(x), np.asarray(y)
+        s = np.asarray(s, dtype=int)
+        n_blocks = len(s) - 1
+        lens = np.diff(s)
+        cho = linalg.cho_factor(np.dot(x.T, x))
+        est = linalg.cho_solve(cho, np.dot(x.T, y))  # (p, 1)
+        U = linalg.cho_solve(cho, x.T).T  # row i is (A^{-1} x_i)^T
+        delete_values = np.zeros((n_blocks, p))
+        for L in np.unique(lens):
+            ii = np.nonzero(lens == L)[0]
+            rows = s[ii].reshape((len(ii), 1)) + np.arange(L)
+            xb, yb, Ub = x[rows], y[rows], U[rows].transpose((0, 2, 1))  # Ub is (k, p, L)
+            S = np.eye(L) - np.matmul(xb, Ub)
+            w = est - np.matmul(Ub, yb)
+            delete_values[ii] = (w + np.matmul(Ub, np.linalg.solve(S, np.matmul(xb, w))))[:, :, 0]
+
+        return est.reshape((1, p)), delete_values
 
 
 class RatioJackknife(Jackknife):
@@ -512,3 +597,76 @@ class RatioJackknife(Jackknife):
                 (n_blocks - 1) * numer[j, ...] / denom[j, ...]
 
         return pseudovalues
+
+
+def _block_values_loop(x, y, s):
+    '''LstsqJackknifeFast.block_values as a loop over the blocks, for _benchmark.'''
+    n, p = _check_shape(x, y)
+    n_blocks = len(s) - 1
+    xtx_block_values = np.zeros((n_blocks, p, p))
+    xty_block_values = np.zeros((n_blocks, p))
+    for i in xrange(n_blocks):
+        xty_block_values[i, ...] = np.dot(
+            x[s[i]:s[i + 1], ...].T, y[s[i]:s[i + 1], ...]).reshape((1, p))
+        xtx_block_values[i, ...] = np.dot(
+            x[s[i]:s[i + 1], ...].T, x[s[i]:s[i + 1], ...])
+
+    return (xty_block_values, xtx_block_values)
+
+
+def _delete_values_loop(xty_block_values, xtx_block_values):
+    '''LstsqJackknifeFast.block_values_to_delete_values as a loop, for _benchmark.'''
+    n_blocks, p = _check_shape_block(xty_block_values, xtx_block_values)
+    delete_values = np.zeros((n_blocks, p))
+    xty_tot = np.sum(xty_block_values, axis=0)
+    xtx_tot = np.sum(xtx_block_values, axis=0)
+    for j in xrange(n_blocks):
+        delete_xty = xty_tot - xty_block_values[j]
+        delete_xtx = xtx_tot - xtx_block_values[j]
+        delete_values[j, ...] = np.linalg.solve(
+            delete_xtx, delete_xty).reshape((1, p))
+
+    return delete_values
+
+
+def _benchmark(n_snp=1000000, p=2, n_blocks=200, seed=0):
+    '''
+    Prints the time to compute the delete values of a random regression with n_snp SNPs,
+    p regressors and n_blocks blocks by looping over the blocks and by LstsqJackknifeFast
+    (batched, or rank_update_delete_values if it applies). Raises AssertionError if the
+    delete values differ.
+
+    '''
+    n_snp, p, n_blocks = int(n_snp), int(p), int(n_blocks)
+    rng = np.random.RandomState(int(seed))
+    x = rng.gamma(2, size=(n_snp, p))
+    x[:, -1] = 1  # intercept
+    y = np.dot(x, rng.normal(size=(p, 1))) + rng.normal(size=(n_snp, 1))
+    s = Jackknife.get_separators(n_snp, n_blocks)
+    print('{N} SNPs, {P} regressors, {B} blocks'.format(N=n_snp, P=p, B=n_blocks))
+    start = time.time()
+    expected = _delete_values_loop(*_block_values_loop(x, y, s))
+    t_loop = time.time() - start
+    start = time.time()
+    if LstsqJackknifeFast.use_rank_update(s, p):
+        name = 'rank update'
+        delete_values = LstsqJackknifeFast.rank_update_delete_values(x, y, s)[1]
+    else:
+        name = 'batched'
+        delete_values = LstsqJackknifeFast.block_values_to_delete_values(
+            *LstsqJackknifeFast.block_values(x, y, s))
+
+    t = time.time() - start
+    err = np.max(np.abs(delete_values - expected)) / np.max(np.abs(expected))
+    print('loop: {L:.3f}s, {F}: {T:.3f}s ({R:.1f}x), max relative difference {E:.1e}'.format(
+        L=t_loop, F=name, T=t, R=t_loop / max(t, 1e-9), E=err))
+    if not err < 1e-8:
+        raise AssertionError('delete values differ from the loop by {E}'.format(E=err))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 5:
+        sys.exit('usage: python jackknife.py [SNPs] [regressors] [blocks] [seed]')
+
+    _benchmark(*sys.argv[1:])
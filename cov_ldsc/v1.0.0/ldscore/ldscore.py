@@ -1,7 +1,16 @@
 from __future__ import division
 import numpy as np
-import bitarray as ba
 import pandas as pd 
+import os
+import time
+import hashlib
+import tempfile
+import fcntl
+import contextlib
+from scipy.linalg import blas
+from scipy import sparse
+import plink
+import parallel
 
 def getBlockLefts(coords, max_dist):
     '''
@@ -11,25 +20,25 @@ def getBlockLefts(coords, max_dist):
     Parameters
     ----------
     coords : array
-        Array of coordinates. Must be sorted.
+        Array of coordinates (SNP index, BP or CM). Must be sorted.
     max_dist : float
         Maximum distance between SNPs included in the same window.
 
     Returns
     -------
-    block_left : 1D np.ndarray with same length as block_left
-        block_left[j] :=  min{k | dist(j, k) < max_dist}.
+    block_left : 1D np.ndarray of ints with same length as coords
+        block_left[j] :=  min{k | dist(j, k) <= max_dist}.
 
     '''
-    M = len(coords)
-    j = 0
-    block_left = np.zeros(M)
-    for i in xrange(M):
-        while j < M and abs(coords[j] - coords[i]) > max_dist:
-            j += 1
-
-        block_left[i] = j
-
+    coords = np.asarray(coords)
+    block_left = np.searchsorted(coords, coords - max_dist, side='left')
+    # coords - max_dist can round across the boundary of the window (e.g., for CM), so
+    # move to the neighbouring group of equal coordinates if dist(j, k) <= max_dist says so
+    prev = np.maximum(block_left - 1, 0)
+    fix = (block_left > 0) & (coords - coords[prev] <= max_dist)
+    block_left[fix] = np.searchsorted(coords, coords[prev[fix]], side='left')
+    fix = coords - coords[block_left] > max_dist
+    block_left[fix] = np.searchsorted(coords, coords[block_left[fix]], side='right')
     return block_left
 
 
@@ -44,20 +53,12 @@ def block_left_to_right(block_left):
 
     Returns
     -------
-    block_right : 1D np.ndarray with same length as block_left
+    block_right : 1D np.ndarray of ints with same length as block_left
         block_right[j] := max {k | block_left[k] <= j}
 
     '''
-    M = len(block_left)
-    j = 0
-    block_right = np.zeros(M)
-    for i in xrange(M):
-        while j < M and block_left[j] <= i:
-            j += 1
-
-        block_right[i] = j
-
-    return block_right
+    block_left = np.asarray(block_left)
+    return np.searchsorted(block_left, np.arange(len(block_left)), side='right')
 
 
 class __GenotypeArrayInMemory__(object):
@@ -68,6 +69,8 @@ class __GenotypeArrayInMemory__(object):
     def __init__(self, fname, n, snp_list, keep_snps=None, keep_indivs=None, mafMin=None):
         self.m = len(snp_list.IDList)
         self.n = n
+        self.fname = fname
+        self._store = None
         self.keep_snps = keep_snps
         self.keep_indivs = keep_indivs
         self.df = np.array(snp_list.df[['CHR', 'SNP', 'BP', 'CM']])
@@ -118,11 +121,118 @@ class __GenotypeArrayInMemory__(object):
     def __filter_maf_(geno, m, n, maf):
         raise NotImplementedError
 
-    def ldScoreVarBlocks(self, block_left, c, annot=None, cov=None):
+    def __hashInputs__(self, h, cov=None, *extra):
+        '''
+        Updates the hash h with the genotype file (path, size and mtime), the number of SNPs
+        and individuals, extra, the kept SNPs and individuals, and cov.
+
+        '''
+        stat = os.stat(self.fname)
+        h.update(repr((os.path.realpath(self.fname), stat.st_size, int(stat.st_mtime),
+            self.m, self.n) + extra))
+        h.update(np.ascontiguousarray(self.kept_snps, dtype='int64').tostring())
+        if self.keep_indivs is not None:
+            h.update(np.ascontiguousarray(self.keep_indivs, dtype='int64').tostring())
+        if cov is not None:
+            h.update(repr(cov.shape))
+            h.update(np.ascontiguousarray(cov, dtype='float64').tostring())
+
+        return h
+
+    def __checkpointDigest__(self, cov, annot, dtype):
+        '''Hex digest of the inputs of an LD Score computation (see __corSumVarBlocks__).'''
+        h = self.__hashInputs__(hashlib.sha1('cov_ldsc checkpoint v1'), cov,
+            np.dtype(dtype).str)
+        h.update(repr(annot.shape))
+        if sparse.issparse(annot):
+            for x in (annot.data, annot.indices, annot.indptr):
+                h.update(np.ascontiguousarray(x).tostring())
+        else:
+            h.update(np.ascontiguousarray(annot, dtype='float64').tostring())
+
+        return h.hexdigest()
+
+    def useGenotypeCache(self, cache_dir, cov=None, dtype=np.float64, max_bytes=None):
+        '''
+        Serves nextSNPs(b, cov, dtype=dtype) from a memory-mapped .npy file in cache_dir that
+        holds the standardized (and residualized) genotypes of the kept SNPs, one row per
+        SNP. The file is keyed by a hash of the genotype file, the kept SNPs and
+        individuals, cov and dtype: it is written by the first run and read by later runs
+        with the same inputs. If max_bytes is not None, the least recently used files are
+        then deleted until the cache holds at most max_bytes.
+
+        Runs can share cache_dir: each file is written to a unique temporary file and
+        renamed into place, files are opened under a shared lock and evicted under an
+        exclusive lock, and files used or written since this run started are not evicted.
+
+        Returns True if the genotypes were already in the cache.
+
+        '''
+        start = time.time()
+        h = self.__hashInputs__(hashlib.sha1('cov_ldsc genotype cache v1'), cov,
+            np.dtype(dtype).str)
+        fname = os.path.join(cache_dir, h.hexdigest() + '.npy')
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # created by another run
+                if not os.path.isdir(cache_dir):
+                    raise
+
+        with _cache_lock(cache_dir, exclusive=False):
+            hit = os.path.exists(fname)
+            if hit:
+                os.utime(fname, None)  # most recently used
+                X = np.load(fname, mmap_mode='r')
+
+        if not hit:
+            fd, tmp = tempfile.mkstemp(suffix='.npy.tmp', dir=cache_dir)
+            os.close(fd)
+            try:
+                X = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype,
+                    shape=(self.m, self.n))
+                self._store = None
+                self._currentSNP = 0
+                for c in xrange(0, self.m, 1000):
+                    b = min(1000, self.m - c)
+                    X[c:c+b, :] = self.nextSNPs(b, cov, dtype=dtype).T
+
+                X.flush()
+                del X
+                self._currentSNP = 0
+                with _cache_lock(cache_dir, exclusive=False):
+                    os.rename(tmp, fname)
+                    X = np.load(fname, mmap_mode='r')
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+        # an open memmap stays valid if another run evicts the file
+        self._store = (X, cov, np.dtype(dtype))
+        if max_bytes is not None:
+            with _cache_lock(cache_dir, exclusive=True):
+                cached = [os.path.join(cache_dir, x) for x in os.listdir(cache_dir)
+                    if x.endswith('.npy')]
+                cached = [(os.path.getmtime(x), os.path.getsize(x), x) for x in cached]
+                total = 0
+                for mtime, size, x in sorted(cached, reverse=True):
+                    if x != fname and mtime < start and total + size > max_bytes:
+                        os.remove(x)
+                    else:
+                        total += size
+
+        return hit
+
+    def ldScoreVarBlocks(self, block_left, c, annot=None, cov=None, n_workers=1,
+                         dtype=np.float64, checkpoint=None, checkpoint_interval=600,
+                         resume=False):
         '''Computes an unbiased estimate of L2(j) for j=1,..,M.'''
         func = lambda x: self.__l2_unbiased__(x, self.n)
-        snp_getter = self.nextSNPs
-        return self.__corSumVarBlocks__(block_left, c, func, snp_getter, annot, cov)
+        snp_getter = lambda b, cov: self.nextSNPs(b, cov, dtype=dtype)
+        return self.__corSumVarBlocks__(block_left, c, func, snp_getter, annot, cov,
+            n_workers=n_workers, dtype=dtype, checkpoint=checkpoint,
+            checkpoint_interval=checkpoint_interval, resume=resume)
 
     def ldScoreBlockJackknife(self, block_left, c, annot=None, jN=10):
         func = lambda x: np.square(x)
@@ -130,12 +240,17 @@ class __GenotypeArrayInMemory__(object):
         return self.__corSumBlockJackknife__(block_left, c, func, snp_getter, annot, jN )
 
     def __l2_unbiased__(self, x, n):
+        '''sq - (1-sq) / denom with sq = x**2, computed in place.'''
         denom = n-2 if n > 2 else n  # allow n<2 for testing purposes
-        sq = np.square(x)
-        return sq - (1-sq) / denom
+        sq = np.square(x, out=x)
+        sq *= 1 + 1 / denom
+        sq -= 1 / denom
+        return sq
 
     # general methods for calculating sums of Pearson correlation coefficients
-    def __corSumVarBlocks__(self, block_left, c, func, snp_getter, annot=None, cov=None):
+    def __corSumVarBlocks__(self, block_left, c, func, snp_getter, annot=None, cov=None,
+                            n_workers=1, dtype=np.float64, checkpoint=None,
+                            checkpoint_interval=600, resume=False):
         '''
         Parameters
         ----------
@@ -154,8 +269,27 @@ class __GenotypeArrayInMemory__(object):
         snp_getter : function(int)
             The method to be used to get the next SNPs (normalized genotypes? Normalized
             genotypes with the minor allele as reference allele? etc)
-        annot: numpy array with shape (m,n_a)
-            SNP annotations.
+        annot: numpy array or scipy.sparse matrix with shape (m,n_a)
+            SNP annotations. If annot is sparse, each window only multiplies by the
+            annotations that are non-zero for some SNP in the window.
+        n_workers : int
+            Number of processes. If n_workers > 1, the chunks of the chromosome are split
+            into n_workers contiguous segments that are computed in parallel. Every pair of
+            SNPs is counted by the segment holding the chunk of its right SNP, so the
+            segments overlap by the window to the left of their first chunk, and summing
+            the segments gives the same estimates as one sequential pass.
+        dtype : np.float64 or np.float32
+            Precision of the genotypes and correlations (snp_getter must return this
+            dtype). cor_sum is accumulated in float64 either way.
+        checkpoint : str, default None
+            Name of a .npz file. If not None, the state of the computation (the next
+            chunk, the window to its left and the partial cor_sum) is written to this file
+            every checkpoint_interval seconds, with a digest of the inputs (genotype file,
+            kept SNPs and individuals, cov, annot and dtype). Requires n_workers == 1.
+        resume : bool
+            If True and checkpoint exists, continue from it instead of from the start of
+            the chromosome. The result is identical to an uninterrupted run. A checkpoint
+            with another digest (or chunks) is refused.
 
         Returns
         -------
@@ -172,9 +306,12 @@ class __GenotypeArrayInMemory__(object):
             annot_m = annot.shape[0]
             if annot_m != self.m:
                 raise ValueError('Incorrect number of SNPs in annot')
+            if sparse.issparse(annot):
+                annot = sparse.csr_matrix(annot, dtype=np.float64, copy=True)
+                annot.sum_duplicates()
+                annot.eliminate_zeros()
 
         n_a = annot.shape[1]  # number of annotations
-        cor_sum = np.zeros((m, n_a))
         # b = index of first SNP for which SNP 0 is not included in LD Score
         b = np.nonzero(block_left > 0)
         if np.any(b):
@@ -185,74 +322,251 @@ class __GenotypeArrayInMemory__(object):
         if b > m:
             c = 1
             b = m
-        l_A = 0  # l_A := index of leftmost SNP in matrix A
-        A = snp_getter(b, cov)
-        rfuncAB = np.zeros((b, c))
-        rfuncBB = np.zeros((c, c))
-        # chunk inside of block
-        for l_B in xrange(0, b, c):  # l_B := index of leftmost SNP in matrix B
-            B = A[:, l_B:l_B+c]
-            np.dot(A.T, B / n, out=rfuncAB)
-            rfuncAB = func(rfuncAB)
-            cor_sum[l_A:l_A+b, :] += np.dot(rfuncAB, annot[l_B:l_B+c, :])
-        # chunk to right of block
-        b0 = b
         md = int(c*np.floor(m/c))
         end = md + 1 if md != m else md
-        for l_B in xrange(b0, end, c):
+        # chunks to the right of the first block, split into contiguous segments
+        chunks = np.arange(b, end, c)
+        n_seg = min(n_workers, len(chunks))
+        if n_seg <= 1:
+            state, digest = None, None
+            if checkpoint is not None:
+                digest = self.__checkpointDigest__(cov, annot, dtype)
+            if checkpoint is not None and resume and os.path.exists(checkpoint):
+                state = _read_checkpoint(checkpoint, block_sizes, c, n, n_a, dtype, digest)
+                cor_sum = state['cor_sum']
+            else:
+                cor_sum = np.zeros((m, n_a))
+            self.__corSumVarBlocksRange__(cor_sum, 0, end, block_sizes, b, c, func,
+                snp_getter, annot, cov, dtype, checkpoint=checkpoint,
+                checkpoint_interval=checkpoint_interval, state=state, digest=digest)
+            return cor_sum
+
+        if checkpoint is not None:
+            raise ValueError('Checkpoints require n_workers == 1.')
+
+        starts = [0] + [int(x[0]) for x in np.array_split(chunks, n_seg)[1:]]
+        stops = starts[1:] + [end]
+        segments = []
+        for (start, stop) in zip(starts, stops):
+            lo = 0 if start == 0 else start - int(block_sizes[start])
+            hi = m if stop == end else stop
+            segments.append((start, stop, lo, hi))
+
+        state = (self, block_sizes, b, c, func, snp_getter, annot, cov, dtype)
+        results = list(parallel.fork_map(_cor_sum_segment, segments, n_seg, state))
+
+        cor_sum = np.zeros((m, n_a))
+        for (start, stop, lo, hi), x in zip(segments, results):
+            cor_sum[lo:hi, :] += x
+
+        return cor_sum
+
+    def __corSumVarBlocksRange__(self, cor_sum, l_B0, stop, block_sizes, b0, c, func,
+                                 snp_getter, annot, cov, dtype=np.float64, checkpoint=None,
+                                 checkpoint_interval=600, state=None, row0=0, digest=None):
+        '''
+        Adds the contributions of the chunks with leftmost SNP in [l_B0, stop) to cor_sum,
+        whose row i holds SNP row0 + i (so a segment only needs the rows it touches).
+        l_B0 is either 0 (the block containing SNP 0, and everything to its right up to
+        stop) or a multiple of c >= b0, in which case the window to the left of l_B0 is
+        read first. See __corSumVarBlocks__ for the other parameters.
+
+        The window to the left of the current chunk is kept in a ring buffer with one row
+        per SNP (SNP j in row j % cap), so moving the window to the right only copies the
+        new chunk in. func may modify its argument in place.
+
+        If checkpoint is not None, the state before the next chunk is written to it (with
+        the input digest) every checkpoint_interval seconds; state (read from a
+        checkpoint, with l_B0 == 0) skips the chunks that were already added to cor_sum.
+
+        '''
+        m, n = self.m, self.n
+        md = int(c*np.floor(m/c))
+        first = max(l_B0, b0)
+        max_b = int(np.max(block_sizes[first:stop])) if stop > first else 0
+        cap = max_b + c
+        ring = np.empty((cap, n), dtype=dtype)
+        B_buf = np.empty(n * c, dtype=dtype)
+        rfuncAB_buf = np.empty(max(max_b, b0) * c, dtype=dtype)
+        rfuncBB_buf = np.empty(c * c, dtype=dtype)
+        syrk = blas.get_blas_funcs('syrk', (ring,))
+        if state is not None:
+            # resume from a checkpoint: restore the window to the left of the next chunk
+            l_B0 = int(state['l_B'])
+            window = state['window']
+            ring[np.arange(l_B0 - len(window), l_B0) % cap] = window
+            self._currentSNP = l_B0
+        elif l_B0 == 0:
+            b = b0
+            l_A = 0  # l_A := index of leftmost SNP in matrix A
+            A = snp_getter(b, cov)
+            rfuncAB = rfuncAB_buf[0:b*c].reshape((b, c))
+            B = B_buf.reshape((n, c))
+            # chunk inside of block
+            for l_B in xrange(0, b, c):  # l_B := index of leftmost SNP in matrix B
+                np.divide(A[:, l_B:l_B+c], n, out=B)
+                np.dot(A.T, B, out=rfuncAB)
+                rfuncAB = func(rfuncAB)
+                cols_B, annot_B = _annot_rows(annot, l_B, l_B+c)
+                cor_sum[l_A-row0:l_A-row0+b, cols_B] += np.dot(rfuncAB, annot_B)
+            # keep the part of the block that can be in the window of the next chunks
+            l_A = max(0, b0 - max_b)
+            ring[np.arange(l_A, b0) % cap] = A[:, l_A:b0].T
+            l_B0 = b0
+            del A
+        else:
+            # start in the middle of the chromosome: read the window to the left of l_B0
+            b = int(block_sizes[l_B0])
+            l_A = l_B0 - b
+            self._currentSNP = l_A
+            if b > 0:
+                ring[np.arange(l_A, l_B0) % cap] = snp_getter(b, cov).T
+
+        lower = np.tril_indices(c, -1)
+        last_checkpoint = time.time()
+        # chunk to right of block
+        for l_B in xrange(l_B0, stop, c):
             # check if the annot matrix is all zeros for this block + chunk
             # this happens w/ sparse categories (i.e., pathways)
             # update the block
-            old_b = b
+            # block_size can't increase more than c
+            # block_size can't be less than c unless it is zero
+            # so the window to the left of the chunk always fits in the ring
             b = int(block_sizes[l_B])
-            if l_B > b0 and b > 0:
-                # block_size can't increase more than c
-                # block_size can't be less than c unless it is zero
-                # both of these things make sense
-                A = np.hstack((A[:, old_b-b+c:old_b], B))
-                l_A += old_b-b+c
-            elif l_B == b0 and b > 0:
-                A = A[:, b0-b:b0]
-                l_A = b0-b
-            elif b == 0:  # no SNPs to left in window, e.g., after a sequence gap
-                A = np.array(()).reshape((n, 0))
-                l_A = l_B
+            l_A = l_B - b
+            if checkpoint is not None and time.time() - last_checkpoint >= checkpoint_interval:
+                _write_checkpoint(checkpoint, l_B, ring[np.arange(l_A, l_B) % cap], cor_sum,
+                    block_sizes, c, digest)
+                last_checkpoint = time.time()
             if l_B == md:
                 c = m - md
-                rfuncAB = np.zeros((b, c))
-                rfuncBB = np.zeros((c, c))
-            if b != old_b:
-                rfuncAB = np.zeros((b, c))
+                lower = np.tril_indices(c, -1)
 
             B = snp_getter(c, cov)
-            p1 = np.all(annot[l_A:l_A+b, :] == 0)
-            p2 = np.all(annot[l_B:l_B+c, :] == 0)
+            r = l_B % cap
+            k = min(c, cap - r)
+            ring[r:r+k] = B[:, 0:k].T
+            ring[0:c-k] = B[:, k:c].T
+            # only the annotations that are non-zero somewhere in A or B contribute
+            cols_A, annot_A = _annot_rows(annot, l_A, l_A+b)
+            cols_B, annot_B = _annot_rows(annot, l_B, l_B+c)
+            p1 = np.all(annot_A == 0)
+            p2 = np.all(annot_B == 0)
             if p1 and p2:
                 continue
 
-            np.dot(A.T, B / n, out=rfuncAB)
-            rfuncAB = func(rfuncAB)
-            cor_sum[l_A:l_A+b, :] += np.dot(rfuncAB, annot[l_B:l_B+c, :])
-            cor_sum[l_B:l_B+c, :] += np.dot(annot[l_A:l_A+b, :].T, rfuncAB).T
-            np.dot(B.T, B / n, out=rfuncBB)
-            rfuncBB = func(rfuncBB)
-            cor_sum[l_B:l_B+c, :] += np.dot(rfuncBB, annot[l_B:l_B+c, :])
+            if not p2:
+                # B.T * B / n is symmetric: compute the upper triangle and mirror it
+                rfuncBB = rfuncBB_buf[0:c*c].reshape((c, c), order='F')
+                rfuncBB = syrk(1 / n, B.T, c=rfuncBB, beta=0.0, overwrite_c=1)
+                rfuncBB[lower] = rfuncBB.T[lower]
+                rfuncBB = func(rfuncBB)
+            if b > 0:
+                B /= n
+                rfuncAB = rfuncAB_buf[0:b*c].reshape((b, c))
+                r = l_A % cap
+                k = min(b, cap - r)
+                np.dot(ring[r:r+k], B, out=rfuncAB[0:k])
+                if k < b:
+                    np.dot(ring[0:b-k], B, out=rfuncAB[k:b])
+                rfuncAB = func(rfuncAB)
+                if not p2:
+                    cor_sum[l_A-row0:l_A-row0+b, cols_B] += np.dot(rfuncAB, annot_B)
+                if not p1:
+                    cor_sum[l_B-row0:l_B-row0+c, cols_A] += np.dot(annot_A.T, rfuncAB).T
+
+            if not p2:
+                cor_sum[l_B-row0:l_B-row0+c, cols_B] += np.dot(rfuncBB, annot_B)
 
         return cor_sum
 
 
+@contextlib.contextmanager
+def _cache_lock(cache_dir, exclusive):
+    '''Holds a shared (or exclusive) lock on cache_dir/.lock (see useGenotypeCache).'''
+    with open(os.path.join(cache_dir, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _annot_rows(annot, start, stop):
+    '''
+    Returns (cols, X), where X holds rows start:stop of annot. If annot is a (canonical)
+    CSR matrix, cols are the indices of the columns with a non-zero entry in these rows
+    and X is a dense array with only these columns; otherwise cols selects every column.
+
+    '''
+    if not sparse.issparse(annot):
+        return slice(None), annot[start:stop, :]
+
+    lo, hi = annot.indptr[start], annot.indptr[stop]
+    j = annot.indices[lo:hi]
+    cols = np.unique(j)
+    X = np.zeros((stop - start, len(cols)))
+    i = np.repeat(np.arange(stop - start), np.diff(annot.indptr[start:stop+1]))
+    X[i, np.searchsorted(cols, j)] = annot.data[lo:hi]
+    return cols, X
+
+
+def _write_checkpoint(fname, l_B, window, cor_sum, block_sizes, c, digest):
+    '''
+    Writes the state of __corSumVarBlocksRange__ before chunk l_B to fname. The file is
+    written to a unique temporary file and replaced atomically, so an interrupted write
+    leaves the previous checkpoint intact.
+
+    '''
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(fname) + '.',
+        dir=os.path.dirname(os.path.abspath(fname)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, l_B=l_B, window=window, cor_sum=cor_sum, block_sizes=block_sizes,
+                c=c, digest=digest)
+        os.rename(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _read_checkpoint(fname, block_sizes, c, n, n_a, dtype, digest):
+    '''Reads a checkpoint written by _write_checkpoint and checks that it is from this run.'''
+    state = dict(np.load(fname))
+    if 'digest' not in state or str(state['digest']) != digest:
+        raise ValueError('The checkpoint {F} was written for different inputs (--bfile, '
+            '--extract, --keep, --maf, --cov, --annot, --cts-bin, --pq-exp or --precision). '
+            'Remove it to start again.'.format(F=fname))
+    if int(state['c']) != c or not np.array_equal(state['block_sizes'], block_sizes) or \
+            state['window'].shape[1] != n or state['window'].dtype != dtype or \
+            state['cor_sum'].shape != (len(block_sizes), n_a):
+        raise ValueError('The checkpoint {F} was written by a different LD Score '
+            'computation.'.format(F=fname))
+
+    return state
+
+
+def _cor_sum_segment(segment):
+    '''Computes one segment of __corSumVarBlocks__ and returns rows lo:hi of cor_sum.'''
+    (start, stop, lo, hi) = segment
+    (geno, block_sizes, b0, c, func, snp_getter, annot, cov, dtype) = parallel.state()
+    cor_sum = np.zeros((hi - lo, annot.shape[1]))
+    geno.__corSumVarBlocksRange__(cor_sum, start, stop, block_sizes, b0, c, func, snp_getter,
+        annot, cov, dtype, row0=lo)
+    return cor_sum
+
+
 class PlinkBEDFile(__GenotypeArrayInMemory__):
     '''
-    Interface for Plink .bed format
+    Interface for Plink .bed format. The genotypes are memory-mapped (one row of packed
+    bytes per SNP) and only the SNPs in the current window are decoded. With keep_indivs,
+    the kept individuals are selected from each decoded window.
     '''
     def __init__(self, fname, n, snp_list, keep_snps=None, keep_indivs=None, mafMin=None):
-        self._bedcode = {
-            2: ba.bitarray('11'),
-            9: ba.bitarray('10'),
-            1: ba.bitarray('01'),
-            0: ba.bitarray('00')
-            }
-
+        # lookup table mapping one .bed byte to the four genotypes it holds (0, 1, 2 copies
+        # of A2, 9 = missing), see plink.py
+        self._bedlut = plink.bed_lut([0, 9, 1, 2], dtype='float64')
         __GenotypeArrayInMemory__.__init__(self, fname, n, snp_list, keep_snps=keep_snps,
             keep_indivs=keep_indivs, mafMin=mafMin)
 
@@ -260,46 +574,20 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
         if not fname.endswith('.bed'):
             raise ValueError('.bed filename must end in .bed')
 
-        fh = open(fname, 'rb')
-        magicNumber = ba.bitarray(endian="little")
-        magicNumber.fromfile(fh, 2)
-        bedMode = ba.bitarray(endian="little")
-        bedMode.fromfile(fh, 1)
-        e = (4 - n % 4) if n % 4 != 0 else 0
-        nru = n + e
-        self.nru = nru
-        # check magic number
-        if magicNumber != ba.bitarray('0011011011011000'):
-            raise IOError("Magic number from Plink .bed file not recognized")
-
-        if bedMode != ba.bitarray('10000000'):
-            raise IOError("Plink .bed file must be in default SNP-major mode")
-
-        # check file length
-        self.geno = ba.bitarray(endian="little")
-        self.geno.fromfile(fh)
-        self.__test_length__(self.geno, self.m, self.nru)
+        self.nru = 4 * plink.packed_len(n)
+        self.geno = plink.open_bed(fname, m, n)
+        self._bed_n = n  # number of individuals in the .bed file
+        self._samples = None  # indices of the kept individuals, None for all
         return (self.nru, self.geno)
 
-    def __test_length__(self, geno, m, nru):
-        exp_len = 2*m*nru
-        real_len = len(geno)
-        if real_len != exp_len:
-            s = "Plink .bed file has {n1} bits, expected {n2}"
-            raise IOError(s.format(n1=real_len, n2=exp_len))
-
     def __filter_indivs__(self, geno, keep_indivs, m, n):
-        n_new = len(keep_indivs)
-        e = (4 - n_new % 4) if n_new % 4 != 0 else 0
-        nru_new = n_new + e
-        nru = self.nru
-        z = ba.bitarray(m*2*nru_new, endian="little")
-        for e, i in enumerate(keep_indivs):
-            z[2*e::2*nru_new] = geno[2*i::2*nru]
-            z[2*e+1::2*nru_new] = geno[2*i+1::2*nru]
-
-        self.nru = nru_new
-        return (z, m, n_new)
+        '''
+        Records the kept individuals, which are gathered from each window as it is
+        decoded (and counted by the MAF filter), so the .bed file is not copied.
+
+        '''
+        self._samples = keep_indivs
+        return (geno, m, len(keep_indivs))
 
     def __filter_snps_maf__(self, geno, m, n, mafMin, keep_snps):
         '''
@@ -307,7 +595,7 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
         Modified from plink_filter.c
         https://github.com/chrchang/plink-ng/blob/master/plink_filter.c
 
-        Genotypes are read forwards (since we are cheating and using endian="little")
+        Genotypes are read forwards, from the lowest bit of each byte.
 
         A := (genotype) & 1010...
         B := (genotype) & 0101...
@@ -327,36 +615,66 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
         major allele frequency = (b+c)/(2*(n-a+c))
         het ct + missing ct = a + b - 2*c
 
-        Why does bitarray not have >> ????
+        a, b and c are computed for every SNP at once from the number of genotypes with
+        each 2-bit code (plink.code_counts, which sums lookup tables over the packed bytes).
+        The call rate and het count of every examined SNP are kept in self.qc_snps,
+        self.call_rate and self.het_ct.
 
         '''
-        nru = self.nru
-        m_poly = 0
-        y = ba.bitarray()
         if keep_snps is None:
-            keep_snps = xrange(m)
-        kept_snps = []
-        freq = []
-        for e, j in enumerate(keep_snps):
-            z = geno[2*nru*j:2*nru*(j+1)]
-            A = z[0::2]
-            a = A.count()
-            B = z[1::2]
-            b = B.count()
-            c = (A & B).count()
-            major_ct = b + c  # number of copies of the major allele
-            n_nomiss = n - a + c  # number of individuals with nonmissing genotypes
-            f = major_ct / (2*n_nomiss) if n_nomiss > 0 else 0
-            het_miss_ct = a+b-2*c  # remove SNPs that are only either het or missing
-            if np.minimum(f, 1-f) > mafMin and het_miss_ct < n:
-                freq.append(f)
-                y += z
-                m_poly += 1
-                kept_snps.append(j)
-
-        return (y, m_poly, n, kept_snps, freq)
-
-    def nextSNPs(self, b, cov=None, minorRef=None):
+            keep_snps = np.arange(m)
+        else:
+            keep_snps = np.array(keep_snps, dtype='int')
+
+        n_snps = len(keep_snps)
+        counts = plink.code_counts(geno, self._bed_n, keep_snps, samples=self._samples)
+        a = counts[:, 1] + counts[:, 3]  # codes with the first bit set
+        b = counts[:, 2] + counts[:, 3]  # codes with the second bit set
+        c = counts[:, 3]
+
+        major_ct = b + c  # number of copies of the major allele
+        n_nomiss = n - a + c  # number of individuals with nonmissing genotypes
+        f = np.zeros(n_snps)
+        ii = n_nomiss > 0
+        f[ii] = major_ct[ii] / (2*n_nomiss[ii])
+        het_miss_ct = a+b-2*c  # remove SNPs that are only either het or missing
+        self.qc_snps = keep_snps
+        self.call_rate = n_nomiss / n
+        self.het_ct = b - c
+        ii = (np.minimum(f, 1-f) > mafMin) & (het_miss_ct < n)
+        kept_snps = keep_snps[ii]
+        freq = f[ii]
+        m_poly = len(kept_snps)
+        return (geno, m_poly, n, kept_snps, freq)
+
+    def __standardize__(self, X, ii, c, minorRef=None):
+        '''
+        Mean-imputes missing genotypes and standardizes a block of SNPs.
+
+        Parameters
+        ----------
+        X : np.array with shape (b, n)
+            One row per SNP.
+        ii : np.array of bools with shape (b, n)
+            True where the genotype is not missing.
+        c : int
+            Index of the first SNP in the block.
+        minorRef: bool, default None
+            Flip the sign of SNPs with frequency > 0.5.
+
+        Returns
+        -------
+        X : np.array with shape (b, n)
+            Rows with mean zero and variance one.
+
+        '''
+        X = plink.standardize(X, ii)
+        if minorRef is not None:
+            X[self.freq[c:c+X.shape[0]] > 0.5] *= -1
+
+        return X
+
+    def nextSNPs(self, b, cov=None, minorRef=None, dtype=np.float64):
         '''
         Unpacks the binary array of genotypes and returns an n x b matrix of floats of
         normalized genotypes for the next b SNPs, where n := number of samples.
@@ -365,13 +683,19 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
         ----------
         b : int
             Number of SNPs to return.
+        cov : np.array with shape (n, k), default None
+            Orthonormal covariate columns. If not None, the genotypes are residualized on
+            the covariates before being returned.
         minorRef: bool, default None
             Should we flip reference alleles so that the minor allele is the reference?
             (This is useful for computing l1 w.r.t. minor allele).
+        dtype : np.float64 or np.float32, default np.float64
+            dtype of the returned matrix. The genotypes are standardized in float64 either
+            way.
 
         Returns
         -------
-        X : np.array with dtype float64 with shape (n, b), where n := number of samples
+        X : np.array with dtype dtype with shape (n, b), where n := number of samples
             Matrix of genotypes normalized to mean zero and variance one. If minorRef is
             not None, then the minor allele will be the positive allele (i.e., two copies
             of the minor allele --> a positive number).
@@ -392,53 +716,244 @@ class PlinkBEDFile(__GenotypeArrayInMemory__):
 
         c = self._currentSNP
         n = self.n
-        nru = self.nru
-        slice = self.geno[2*c*nru:2*(c+b)*nru]
-        X = np.array(slice.decode(self._bedcode), dtype="float64").reshape((b, nru)).T
-        X = X[0:n, :]
-        Y = np.zeros(X.shape)
-        
-
-        for j in xrange(0, b):
-            newsnp = X[:, j]
-            ii = newsnp != 9
-            avg = np.mean(newsnp[ii])
-            newsnp[np.logical_not(ii)] = avg
-            denom = np.std(newsnp)
-            if denom == 0:
-                denom = 1
-
-            if minorRef is not None and self.freq[self._currentSNP + j] > 0.5:
-                denom = denom*-1
-
-            Y[:, j] = (newsnp - avg) / denom
-            '''
-            Z[:, j] = Y[:, j]-np.dot(pca,Y[:,j])
-            Z[:, j] = np.mean(Z[:])
-            '''
-
-            if cov is not None:  
-                
-                #should match to the indiv? 
-
-                T=np.zeros(len(Y[:,j]))
-                for i in range(2,cov.shape[1]): 
-                    T= T+np.dot(cov.iloc[:,i],Y[:,j])*cov.iloc[:,i] 
-                newsnp=Y[:,j]-T
-
-            #newsnp = Z
-                #ii = newsnp != 9
-                avg = np.mean(newsnp[ii])
-                newsnp[np.logical_not(ii)] = avg
-                denom = np.std(newsnp)
-                if denom == 0:
-                    denom = 1
-
-                if minorRef is not None and self.freq[self._currentSNP + j] > 0.5:
-                    denom = denom*-1
-
-                Y[:, j] = (newsnp - avg) / denom
-
+        if self._store is not None and self._store[1] is cov and self._store[2] == dtype \
+                and minorRef is None:
+            # standardized genotypes from the cache (see useGenotypeCache)
+            self._currentSNP += b
+            return np.ascontiguousarray(self._store[0][c:c+b, :].T)
+
+        # read only the rows of the SNPs in this window and decode them at once: one row
+        # of the lookup table per .bed byte
+        X = plink.decode(self.geno[self.kept_snps[c:c+b]], self._bed_n, lut=self._bedlut)
+        if self._samples is not None:
+            X = X[:, self._samples]
+        ii = X != 9
+        X = self.__standardize__(X, ii, c, minorRef)
+        if cov is not None:
+            # residualize all b SNPs on the covariates with one pair of matrix products,
+            # then re-impute and re-standardize the residuals
+            X = X - np.dot(np.dot(X, cov), cov.T)
+            X = self.__standardize__(X, ii, c, minorRef)
+
+        Y = np.ascontiguousarray(X.T, dtype=dtype)
         self._currentSNP += b
         
         return Y
+
+
+def _nextSNPs_bitarray(bits, c, b, nru, n, bedcode):
+    '''
+    nextSNPs as computed before plink.py (for _benchmark_decode): the window is decoded
+    from a bitarray of the kept SNPs and standardized one SNP at a time.
+
+    '''
+    X = np.array(bits[2*c*nru:2*(c+b)*nru].decode(bedcode), dtype='float64')
+    X = X.reshape((b, nru)).T[0:n, :]
+    Y = np.zeros(X.shape)
+    for j in xrange(0, b):
+        newsnp = X[:, j]
+        ii = newsnp != 9
+        avg = np.mean(newsnp[ii])
+        newsnp[np.logical_not(ii)] = avg
+        denom = np.std(newsnp)
+        if denom == 0:
+            denom = 1
+
+        Y[:, j] = (newsnp - avg) / denom
+
+    return Y
+
+
+def _benchmark_decode(prefix, block=1000):
+    '''
+    Prints the time to decode and standardize all SNPs of a bfile with nextSNPs and with
+    the bitarray decoder it replaced (if bitarray is installed), and checks that both
+    give the same genotypes.
+
+    '''
+    import parse as ps
+    bim, fam = ps.PlinkBIMFile(prefix + '.bim'), ps.PlinkFAMFile(prefix + '.fam')
+    geno = PlinkBEDFile(prefix + '.bed', len(fam.IDList), bim)
+    m, n = geno.m, geno.n
+    start = time.time()
+    new = [geno.nextSNPs(min(block, m - c)) for c in xrange(0, m, block)]
+    t = max(time.time() - start, 1e-9)
+    print 'lookup table decoder: {T:.3f}s, {R:.1f} M genotypes/s'.format(T=t,
+        R=m * n / t / 1e6)
+    try:
+        import bitarray as ba
+    except ImportError:
+        print 'bitarray is not installed, skipping the bitarray decoder'
+        return
+
+    bedcode = {2: ba.bitarray('11'), 9: ba.bitarray('10'), 1: ba.bitarray('01'),
+        0: ba.bitarray('00')}
+    bits, rows = ba.bitarray(endian='little'), ba.bitarray(endian='little')
+    with open(prefix + '.bed', 'rb') as fh:
+        fh.seek(3)
+        rows.fromfile(fh)
+
+    for j in geno.kept_snps:  # as in the bitarray MAF filter, outside the timing
+        bits += rows[2*geno.nru*j:2*geno.nru*(j+1)]
+
+    start = time.time()
+    old = [_nextSNPs_bitarray(bits, c, min(block, m - c), geno.nru, n, bedcode)
+        for c in xrange(0, m, block)]
+    t_old = max(time.time() - start, 1e-9)
+    print 'bitarray decoder: {T:.3f}s, {R:.1f} M genotypes/s ({S:.1f}x slower)'.format(
+        T=t_old, R=m * n / t_old / 1e6, S=t_old / t)
+    print 'identical output: {B}'.format(B=all(np.array_equal(x, y)
+        for x, y in zip(new, old)))
+
+
+def _block_lefts_loop(coords, max_dist):
+    '''getBlockLefts as implemented before np.searchsorted (for _check_blocks).'''
+    M = len(coords)
+    j = 0
+    block_left = np.zeros(M)
+    for i in xrange(M):
+        while j < M and abs(coords[j] - coords[i]) > max_dist:
+            j += 1
+
+        block_left[i] = j
+
+    return block_left
+
+
+def _block_left_to_right_loop(block_left):
+    '''block_left_to_right as implemented before np.searchsorted (for _check_blocks).'''
+    M = len(block_left)
+    j = 0
+    block_right = np.zeros(M)
+    for i in xrange(M):
+        while j < M and block_left[j] <= i:
+            j += 1
+
+        block_right[i] = j
+
+    return block_right
+
+
+def _check_blocks(n_trials=3000, seed=0):
+    '''
+    Checks getBlockLefts and block_left_to_right against the loops they replaced on random
+    sorted coordinates of each window type: SNP indices (--ld-wind-snps), base pairs with
+    ties (--ld-wind-kb), and cM with ties and values that round across the window
+    boundary (--ld-wind-cm). Raises AssertionError on the first mismatch.
+
+    '''
+    rng = np.random.RandomState(int(seed))
+    for i in xrange(int(n_trials)):
+        m = rng.randint(1, 300)
+        kind = i % 4
+        if kind == 0:
+            coords, max_dist = np.arange(m), rng.randint(0, 60)
+        elif kind == 1:
+            coords, max_dist = np.sort(rng.randint(0, 30000, m)), 1000 * rng.randint(0, 20)
+        elif kind == 2:
+            coords = np.sort(np.round(rng.uniform(0, 3, m), 2))
+            max_dist = rng.choice([0, 0.01, 0.05, 0.1, 0.3, 1])
+        else:
+            coords = np.cumsum(rng.choice([0, 0.01, 0.1, 0.07], m))
+            max_dist = rng.choice([0.01, 0.03, 0.07, 0.1, 0.17])
+
+        block_left = getBlockLefts(coords, max_dist)
+        block_right = block_left_to_right(block_left)
+        expected = _block_lefts_loop(coords, max_dist)
+        if block_left.dtype.kind != 'i' or not np.array_equal(block_left, expected):
+            raise AssertionError('getBlockLefts({C}, {D}) = {B}, expected {E}'.format(
+                C=list(coords), D=max_dist, B=list(block_left), E=list(expected)))
+        expected = _block_left_to_right_loop(expected)
+        if block_right.dtype.kind != 'i' or not np.array_equal(block_right, expected):
+            raise AssertionError('block_left_to_right({L}) = {B}, expected {E}'.format(
+                L=list(block_left), B=list(block_right), E=list(expected)))
+
+    print 'getBlockLefts and block_left_to_right match the loops on {N} inputs'.format(
+        N=n_trials)
+
+
+def _memory(field):
+    '''Returns VmRSS or VmHWM (peak) of this process in bytes, or None if unavailable.'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    return None
+
+
+def _benchmark_windows(prefix, ld_wind_snps=1000, c=50):
+    '''
+    Prints the time per chunk of __corSumVarBlocks__ on a bfile with a window of
+    ld_wind_snps SNPs, and how far the peak memory of the computation rises above the
+    memory in use before it, next to the size of the window (ring buffer). Allocations
+    made for each window, e.g., copies of the window or fresh correlation matrices, show
+    up in that peak.
+
+    '''
+    import parse as ps
+    bim, fam = ps.PlinkBIMFile(prefix + '.bim'), ps.PlinkFAMFile(prefix + '.fam')
+    geno = PlinkBEDFile(prefix + '.bed', len(fam.IDList), bim)
+    m, n, c = geno.m, geno.n, int(c)
+    block_left = getBlockLefts(np.arange(m), int(ld_wind_snps))
+    ring = (np.max(np.arange(m) - block_left) + 2*c) * n * 8
+    try:  # reset the peak (Linux >= 4.0)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        print 'cannot reset the peak memory of this process, the peak is since start'
+
+    rss = _memory('VmRSS')
+    start = time.time()
+    geno.ldScoreVarBlocks(block_left, c)
+    t = time.time() - start
+    n_chunks = int(np.ceil(m / c))
+    print '{M} SNPs, {N} individuals, window of {W} SNPs, {K} chunks of {C} SNPs'.format(
+        M=m, N=n, W=ld_wind_snps, K=n_chunks, C=c)
+    print 'time: {T:.3f}s, {P:.2f}ms per chunk'.format(T=t, P=1000 * t / n_chunks)
+    if rss is not None:
+        print 'peak memory above the start: {X:.1f}MB (window ring buffer {R:.1f}MB)'.format(
+            X=(_memory('VmHWM') - rss) / 2**20, R=ring / 2**20)
+
+
+def _check_precision(prefix, ld_wind_kb=1000, c=50):
+    '''
+    Computes the LD Scores of a bfile (window of ld_wind_kb kb, chunks of c SNPs) with the
+    correlations in float64 and in float32 (--precision), and prints the time of each, the
+    maximum absolute deviation of float32, relative to the largest LD Score, and the number
+    of SNPs whose printed LD Score (%.3f) differs.
+
+    '''
+    import parse as ps
+    bim, fam = ps.PlinkBIMFile(prefix + '.bim'), ps.PlinkFAMFile(prefix + '.fam')
+    l2 = {}
+    for dtype in (np.float64, np.float32):
+        geno = PlinkBEDFile(prefix + '.bed', len(fam.IDList), bim)
+        block_left = getBlockLefts(geno.df[:, 2].astype(float), 1000 * float(ld_wind_kb))
+        start = time.time()
+        l2[dtype] = geno.ldScoreVarBlocks(block_left, int(c), dtype=dtype)
+        print '{D}: {T:.3f}s'.format(D=np.dtype(dtype).name, T=time.time() - start)
+
+    x, y = l2[np.float64], l2[np.float32]
+    dev, top = np.max(np.abs(y - x)), np.max(np.abs(x))
+    printed = np.sum(np.any(np.char.mod('%.3f', x) != np.char.mod('%.3f', y), axis=1))
+    print '{M} SNPs, {N} individuals, window of {W}kb'.format(M=geno.m, N=geno.n, W=ld_wind_kb)
+    print 'max |L2_32 - L2_64| = {D:.3g} (max |L2| = {L:.3g}, relative {R:.3g})'.format(
+        D=dev, L=top, R=dev / top if top > 0 else 0)
+    print 'printed LD Scores that differ: {P} of {M} SNPs'.format(P=printed, M=len(x))
+
+
+if __name__ == '__main__':
+    import sys
+    commands = {'decode': (_benchmark_decode, '<bfile prefix>'),
+                'windows': (_benchmark_windows, '<bfile prefix> [window in SNPs] [chunk size]'),
+                'check-blocks': (_check_blocks, '[trials] [seed]'),
+                'precision': (_check_precision, '<bfile prefix> [window in kb] [chunk size]')}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        sys.exit('usage:\n' + '\n'.join('  python ldscore.py {C} {A}'.format(C=c, A=a)
+            for c, (f, a) in sorted(commands.items())))
+
+    commands[sys.argv[1]][0](*sys.argv[2:])
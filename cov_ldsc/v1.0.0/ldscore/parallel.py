@@ -0,0 +1,53 @@
+'''
+Map a function over jobs in forked worker processes that share read-only inputs.
+
+'''
+
+import multiprocessing
+
+# The state of the fork_map call being run. The worker processes are forked after it is
+# set, so they inherit it instead of receiving it pickled with each job: large inputs (LD
+# Scores, genotypes) are not copied to every worker, and the state may hold objects that
+# cannot be pickled (e.g., functions).
+_STATE = None
+
+
+def state():
+    '''The state of the fork_map call being run, for the function it maps.'''
+    return _STATE
+
+
+def fork_map(func, jobs, n_workers, state=None, ordered=True):
+    '''
+    Yields func(job) for each job, computed in min(n_workers, len(jobs)) forked processes,
+    or in this one if that is 1. func is a module-level function, which reads state with
+    parallel.state(). The results are in the order of jobs if ordered, else in the order
+    they finish. If the caller stops early (or func raises), the workers are terminated.
+
+    '''
+    global _STATE
+    jobs = list(jobs)
+    n = min(n_workers, len(jobs))
+    previous, _STATE = _STATE, state
+    pool, done = None, False
+    try:
+        if n > 1:
+            pool = multiprocessing.Pool(n)
+            results = pool.imap(func, jobs) if ordered else pool.imap_unordered(func, jobs)
+        else:
+            results = (func(job) for job in jobs)
+
+        for x in results:
+            yield x
+
+        done = True
+    finally:
+        if pool is not None:
+            if done:
+                pool.close()
+            else:
+                pool.terminate()
+
+            pool.join()
+
+        _STATE = previous
@@ -9,17 +9,40 @@ from __future__ import division
 import numpy as np
 import pandas as pd
 import os
+import time
+import gzip
+import bz2
 
 
 def series_eq(x, y):
     '''Compare series, return False if lengths not equal.'''
-    return len(x) == len(y) and (x == y).all()
+    return len(x) == len(y) and (np.asarray(x) == np.asarray(y)).all()
 
 
 def read_csv(fh, **kwargs):
     return pd.read_csv(fh, delim_whitespace=True, na_values='.', **kwargs)
 
 
+def sniff_sep(fh, compression=None):
+    '''
+    Returns '\t' if the first two lines of fh are tab-delimited (same number of fields and no
+    spaces), which lets read_csv split on a single character, else None (any whitespace).
+
+    '''
+    openfunc = {'gzip': gzip.open, 'bz2': bz2.BZ2File}.get(compression, open)
+    f = openfunc(fh, 'rb')
+    try:
+        lines = [f.readline().rstrip('\r\n') for _ in xrange(2)]
+    finally:
+        f.close()
+
+    if any(' ' in l for l in lines) or len(set(l.count('\t') for l in lines if l)) != 1 or \
+            '\t' not in lines[0]:
+        return None
+
+    return '\t'
+
+
 def sub_chr(s, chr):
     '''Substitute chr for @, else append chr to the end of str.'''
     if '@' not in s:
@@ -57,6 +80,24 @@ def get_compression(fh):
     return compression
 
 
+def read_files(parsefunc, fnames, pool=None, timings=None):
+    '''
+    Returns [parsefunc(f) for f in fnames], parsing the files in parallel if pool (e.g., a
+    ThreadPool) is not None. If timings is not None, appends (f, seconds) for each file.
+
+    '''
+    def timed(fh):
+        start = time.time()
+        x = parsefunc(fh)
+        return x, time.time() - start
+
+    out = pool.map(timed, fnames) if pool is not None else map(timed, fnames)
+    if timings is not None:
+        timings.extend(zip(fnames, [t for x, t in out]))
+
+    return [x for x, t in out]
+
+
 def read_cts(fh, match_snps):
     '''Reads files for --cts-bin.'''
     compression = get_compression(fh)
@@ -68,7 +109,11 @@ def read_cts(fh, match_snps):
 
 
 def sumstats(fh, alleles=False, dropna=True):
-    '''Parses .sumstats files. See docs/file_formats_sumstats.txt.'''
+    '''
+    Parses .sumstats files. See docs/file_formats_sumstats.txt. SNP is categorical (integer
+    codes into the dictionary of the distinct SNPs, in order of appearance).
+
+    '''
     dtype_dict = {'SNP': str,   'Z': float, 'N': float, 'A1': str, 'A2': str}
     compression = get_compression(fh)
     usecols = ['SNP', 'Z', 'N']
@@ -76,21 +121,27 @@ def sumstats(fh, alleles=False, dropna=True):
         usecols += ['A1', 'A2']
 
     try:
-        x = read_csv(fh, usecols=usecols, dtype=dtype_dict, compression=compression)
+        sep = sniff_sep(fh, compression)
+        if sep is None:
+            x = read_csv(fh, usecols=usecols, dtype=dtype_dict, compression=compression)
+        else:
+            x = pd.read_csv(fh, sep=sep, na_values='.', usecols=usecols, dtype=dtype_dict,
+                            compression=compression)
     except (AttributeError, ValueError) as e:
         raise ValueError('Improperly formatted sumstats file: ' + str(e.args))
 
+    x['SNP'] = pd.Categorical.from_codes(*pd.factorize(x.SNP))
     if dropna:
         x = x.dropna(how='any')
 
     return x
 
 
-def ldscore_fromlist(flist, num=None):
+def ldscore_fromlist(flist, num=None, pool=None, timings=None):
     '''Sideways concatenation of a list of LD Score files.'''
     ldscore_array = []
     for i, fh in enumerate(flist):
-        y = ldscore(fh, num)
+        y = ldscore(fh, num, pool, timings)
         if i > 0:
             if not series_eq(y.SNP, ldscore_array[0].SNP):
                 raise ValueError('LD Scores for concatenation must have identical SNP columns.')
@@ -112,6 +163,109 @@ def l2_parser(fh, compression):
     return x
 
 
+def _round_as_printed(x):
+    '''
+    float('%.3f' % x) for each entry of x. np.round gives the same value except within rounding
+    error of a tie (k + 0.5)/1000, where x*1000 can round the other way, so only those
+    entries are formatted.
+
+    '''
+    x = np.asarray(x, dtype='float64')
+    out = np.round(x, 3)
+    t = np.abs(x*1000)
+    with np.errstate(invalid='ignore'):
+        tie = np.abs(t - np.floor(t) - 0.5) < 1e-9*np.maximum(t, 1)
+
+    if np.any(tie):
+        out[tie] = np.char.mod('%.3f', x[tie]).astype('float64')
+
+    return out
+
+
+def write_l2_cols(fh, chunks, n):
+    '''
+    Writes the LD Scores chunks (DataFrames with columns CHR, SNP, BP, then LD Scores, n
+    rows in total) to the binary columnar format: a directory fh (e.g.,
+    out.l2.ldscore.cols) with CHR.npy and BP.npy, the SNPs as int32 codes SNP.npy into the
+    dictionary SNP_dict.npy, the LD Scores as a column-major float64 matrix LD.npy, and
+    their names in columns.txt. LD Scores are stored as they are printed (see
+    _round_as_printed) so that both formats give the same regression. The directory is
+    written to fh.tmp and renamed.
+
+    '''
+    tmp = fh + '.tmp'
+    if not os.path.isdir(tmp):
+        os.makedirs(tmp)
+
+    info, ld, i = {'CHR': [], 'SNP': [], 'BP': []}, None, 0
+    for df in chunks:
+        if ld is None:
+            columns = df.columns[3:]
+            ld = np.lib.format.open_memmap(os.path.join(tmp, 'LD.npy'), mode='w+',
+                dtype='float64', shape=(n, len(columns)), fortran_order=True)
+
+        for c in info:
+            info[c].append(df[c].values)
+
+        ld[i:i+len(df)] = _round_as_printed(df.iloc[:, 3:].values)
+        i += len(df)
+
+    ld.flush()
+    del ld
+    for c in ['CHR', 'BP']:
+        np.save(os.path.join(tmp, c + '.npy'), np.concatenate(info[c]))
+
+    codes, snps = pd.factorize(np.concatenate(info['SNP']))
+    np.save(os.path.join(tmp, 'SNP.npy'), codes.astype('int32'))
+    np.save(os.path.join(tmp, 'SNP_dict.npy'), snps.astype(str))
+
+    with open(os.path.join(tmp, 'columns.txt'), 'w') as f:
+        f.write('\n'.join(columns) + '\n')
+
+    if os.path.isdir(fh):
+        for f in os.listdir(fh):
+            os.remove(os.path.join(fh, f))
+        os.rmdir(fh)
+
+    os.rename(tmp, fh)
+
+
+def l2_cols_parser(fh):
+    '''
+    Parse LD Score files in the binary columnar format (see write_l2_cols). The LD Scores
+    are a view of LD.npy mapped copy-on-write (the frame keeps the map open), and SNP is
+    categorical, with the codes and dictionary of the file.
+
+    '''
+    with open(os.path.join(fh, 'columns.txt')) as f:
+        cols = [c for c in f.read().split('\n') if c]
+
+    ld = np.load(os.path.join(fh, 'LD.npy'), mmap_mode='c')
+    x = pd.DataFrame(ld, columns=cols, copy=False)
+    snps = np.load(os.path.join(fh, 'SNP_dict.npy')).astype(object)
+    x.insert(0, 'CHR', np.load(os.path.join(fh, 'CHR.npy')))
+    x.insert(1, 'SNP', pd.Categorical.from_codes(np.load(os.path.join(fh, 'SNP.npy')), snps))
+    x.insert(2, 'BP', np.load(os.path.join(fh, 'BP.npy')))
+    return x
+
+
+def l2_reader(fh):
+    '''
+    Parse the LD Score file fh (e.g., ld/1.l2.ldscore), from the binary columnar format
+    fh.cols if it exists and is at least as new as the text file fh[.gz|.bz2].
+
+    '''
+    cols = fh + '.cols'
+    if os.path.isdir(cols):
+        text = [fh + s for s in ['', '.gz', '.bz2'] if os.path.exists(fh + s)]
+        t = os.path.getmtime(os.path.join(cols, 'columns.txt'))
+        if all(os.path.getmtime(f) <= t for f in text):
+            return l2_cols_parser(cols)
+
+    s, compression = which_compression(fh)
+    return l2_parser(fh + s, compression)
+
+
 def annot_parser(fh, compression, frqfile_full=None, compression_frq=None):
     '''Parse annot files'''
     df_annot = read_csv(fh, header=0, compression=compression).drop(['SNP','CHR', 'BP', 'CM'], axis=1, errors='ignore').astype(float)
@@ -129,17 +283,19 @@ def frq_parser(fh, compression):
     return df[['SNP', 'FRQ']]
 
 
-def ldscore(fh, num=None):
-    '''Parse .l2.ldscore files, split across num chromosomes. See docs/file_formats_ld.txt.'''
+def ldscore(fh, num=None, pool=None, timings=None):
+    '''
+    Parse .l2.ldscore files, split across num chromosomes. See docs/file_formats_ld.txt.
+    pool and timings are passed to read_files.
+
+    '''
     suffix = '.l2.ldscore'
     if num is not None:  # num files, e.g., one per chromosome
-        first_fh = sub_chr(fh, 1) + suffix
-        s, compression = which_compression(first_fh)
-        chr_ld = [l2_parser(sub_chr(fh, i) + suffix + s, compression) for i in xrange(1, num + 1)]
+        fnames = [sub_chr(fh, i) + suffix for i in xrange(1, num + 1)]
+        chr_ld = read_files(l2_reader, fnames, pool, timings)
         x = pd.concat(chr_ld)  # automatically sorted by chromosome
     else:  # just one file
-        s, compression = which_compression(fh + suffix)
-        x = l2_parser(fh + suffix + s, compression)
+        x = read_files(l2_reader, [fh + suffix], timings=timings)[0]
 
     x = x.sort_values(by=['CHR', 'BP']) # SEs will be wrong unless sorted
     x = x.drop(['CHR', 'BP'], axis=1).drop_duplicates(subset='SNP')
@@ -166,11 +322,12 @@ def M_fromlist(flist, num=None, N=2, common=False):
     return np.hstack([M(fh, num, N, common) for fh in flist])
 
 
-def annot(fh_list, num=None, frqfile=None):
+def annot(fh_list, num=None, frqfile=None, pool=None, timings=None):
     '''
     Parses .annot files and returns an overlap matrix. See docs/file_formats_ld.txt.
     If num is not None, parses .annot files split across [num] chromosomes (e.g., the
-    output of parallelizing ldsc.py --l2 across chromosomes).
+    output of parallelizing ldsc.py --l2 across chromosomes), one chromosome at a time
+    or in parallel with pool. pool and timings are passed to read_files.
 
     '''
     annot_suffix = ['.annot' for fh in fh_list]
@@ -188,9 +345,12 @@ def annot(fh_list, num=None, frqfile=None):
             frq_s, frq_compression = which_compression(first_frqfile)
             frq_suffix += frq_s
 
-        y = []
-        M_tot = 0
-        for chr in xrange(1, num + 1):
+        chr_fnames = [','.join(sub_chr(fh, chr) + annot_suffix[i] for i, fh in enumerate(fh_list))
+                      for chr in xrange(1, num + 1)]
+        chr_of = dict(zip(chr_fnames, xrange(1, num + 1)))
+
+        def chr_overlap(fnames):
+            chr = chr_of[fnames]
             if frqfile is not None:
                 df_annot_chr_list = [annot_parser(sub_chr(fh, chr) + annot_suffix[i], annot_compression[i],
                                                   sub_chr(frqfile, chr) + frq_suffix, frq_compression)
@@ -201,10 +361,11 @@ def annot(fh_list, num=None, frqfile=None):
 
             annot_matrix_chr_list = [np.matrix(df_annot_chr) for df_annot_chr in df_annot_chr_list]
             annot_matrix_chr = np.hstack(annot_matrix_chr_list)
-            y.append(np.dot(annot_matrix_chr.T, annot_matrix_chr))
-            M_tot += len(df_annot_chr_list[0])
+            return np.dot(annot_matrix_chr.T, annot_matrix_chr), len(df_annot_chr_list[0])
 
-        x = sum(y)
+        y = read_files(chr_overlap, chr_fnames, pool, timings)
+        x = sum(z[0] for z in y)
+        M_tot = sum(z[1] for z in y)
     else:  # just one file
         for i, fh in enumerate(fh_list):
             annot_s, annot_comp_single = which_compression(fh + annot_suffix[i])
@@ -18,6 +18,9 @@ from collections import namedtuple
 np.seterr(divide='raise', invalid='raise')
 
 s = lambda x: remove_brackets(str(np.matrix(x)))
+# combined block jackknife of --two-step (at module level so that fits can be pickled)
+TwoStepJackknife = namedtuple('TwoStepJackknife',
+                              ['est', 'jknife_se', 'jknife_est', 'jknife_var', 'jknife_cov', 'delete_values'])
 
 
 def update_separators(s, ii):
@@ -328,9 +331,7 @@ class LD_Score_Regression(object):
             delete_values, est)
         jknife_est, jknife_var, jknife_se, jknife_cov = jk.Jackknife.jknife(
             pseudovalues)
-        jknife = namedtuple('jknife',
-                            ['est', 'jknife_se', 'jknife_est', 'jknife_var', 'jknife_cov', 'delete_values'])
-        return jknife(est, jknife_se, jknife_est, jknife_var, jknife_cov, delete_values)
+        return TwoStepJackknife(est, jknife_se, jknife_est, jknife_var, jknife_cov, delete_values)
 
 
 class Hsq(LD_Score_Regression):
@@ -680,14 +681,18 @@ class Gencov(LD_Score_Regression):
 class RG(object):
 
     def __init__(self, z1, z2, x, w, N1, N2, M, intercept_hsq1=None, intercept_hsq2=None,
-                 intercept_gencov=None, n_blocks=200, slow=False, twostep=None):
+                 intercept_gencov=None, n_blocks=200, slow=False, twostep=None, hsq1=None,
+                 hsq2=None):
         self.intercept_gencov = intercept_gencov
         self._negative_hsq = None
         n_snp, n_annot = x.shape
-        hsq1 = Hsq(np.square(z1), x, w, N1, M, n_blocks=n_blocks, intercept=intercept_hsq1,
-                   slow=slow, twostep=twostep)
-        hsq2 = Hsq(np.square(z2), x, w, N2, M, n_blocks=n_blocks, intercept=intercept_hsq2,
-                   slow=slow, twostep=twostep)
+        # hsq1 and hsq2 may be Hsq fits of the same data computed earlier (e.g., cached)
+        if hsq1 is None:
+            hsq1 = Hsq(np.square(z1), x, w, N1, M, n_blocks=n_blocks, intercept=intercept_hsq1,
+                       slow=slow, twostep=twostep)
+        if hsq2 is None:
+            hsq2 = Hsq(np.square(z2), x, w, N2, M, n_blocks=n_blocks, intercept=intercept_hsq2,
+                       slow=slow, twostep=twostep)
         gencov = Gencov(z1, z2, x, w, N1, N2, M, hsq1.tot, hsq2.tot, hsq1.intercept,
                         hsq2.intercept, n_blocks, intercept_gencov=intercept_gencov, slow=slow,
                         twostep=twostep)
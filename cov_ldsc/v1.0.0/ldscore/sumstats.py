@@ -13,10 +13,14 @@ from scipy import stats
 import itertools as it
 import parse as ps
 import regressions as reg
+import parallel
 import sys
 import traceback
 import copy
 import os
+import time
+import hashlib
+from multiprocessing.pool import ThreadPool
 
 
 _N_CHR = 22
@@ -46,6 +50,14 @@ FLIP_ALLELES = {''.join(x):
                 # strand flip
                 ((x[0] == COMPLEMENT[x[3]]) and (x[1] == COMPLEMENT[x[2]]))
                 for x in MATCH_ALLELES}
+# reference orientation of the alleles of each valid SNP, up to strand and ref allele flip
+_REF_ALLELES = {x: min(x, x[::-1], COMPLEMENT[x[0]] + COMPLEMENT[x[1]],
+                       COMPLEMENT[x[1]] + COMPLEMENT[x[0]]) for x in VALID_SNPS}
+# (class, sign) of the alleles of each valid SNP: two SNPs match iff they have the same
+# class, and one is a ref allele flip of the other iff their signs differ
+ALLELE_CLASS = {x: (sorted(set(_REF_ALLELES.values())).index(_REF_ALLELES[x]),
+                    1 if x[0] in _REF_ALLELES[x][0] + COMPLEMENT[_REF_ALLELES[x][0]] else -1)
+                for x in VALID_SNPS}
 
 
 def _splitp(fstr):
@@ -65,35 +77,156 @@ def _select_and_log(x, ii, log, msg):
     return x
 
 
+def _snp_codes(x, y):
+    '''
+    Integer codes of the SNPs of the tables x and y in one dictionary, the categories of
+    x.SNP. SNP columns are categorical (see parse.sumstats and _read_ld), so only the
+    dictionary of y is looked up in that of x, not each of its rows (nothing is looked up
+    if y already shares the dictionary of x). Returns (codes of x, codes of y, size of the
+    dictionary), with code -1 for missing SNPs and SNPs of y that are not in x.
+
+    '''
+    x, y = [z.SNP.values for z in (x, y)]
+    if not isinstance(x, pd.Categorical):
+        x = pd.Categorical.from_codes(*pd.factorize(x))
+    if not isinstance(y, pd.Categorical):
+        y = pd.Categorical.from_codes(*pd.factorize(y))
+
+    codes = y.codes
+    if y.categories is not x.categories and not y.categories.equals(x.categories):
+        codes = np.append(x.categories.get_indexer(y.categories), -1)[codes]
+
+    return x.codes, codes, len(x.categories)
+
+
+def _snp_index(x_codes, y_codes, n):
+    '''
+    Row of x of the SNP of each row of y (-1 if none), from the codes of _snp_codes, or
+    None if the SNPs of x are not unique.
+
+    '''
+    rows = np.arange(len(x_codes))
+    pos = -np.ones(n, dtype=int)
+    pos[x_codes] = rows
+    if np.any(x_codes < 0) or np.any(pos[x_codes] != rows):
+        return None
+
+    return np.append(pos, -1)[y_codes]
+
+
 def smart_merge(x, y):
-    '''Check if SNP columns are equal. If so, save time by using concat instead of merge.'''
-    if len(x) == len(y) and (x.index == y.index).all() and (x.SNP == y.SNP).all():
+    '''
+    Check if SNP columns are equal. If so, save time by using concat instead of merge.
+    Otherwise, if the SNPs of x are unique, join on the integer codes of the SNPs (same rows
+    and order as an inner merge).
+
+    '''
+    x_codes, y_codes, n = _snp_codes(x, y)
+    if len(x) == len(y) and (x.index == y.index).all() and (x_codes == y_codes).all() and \
+            (x_codes >= 0).all():
         x = x.reset_index(drop=True)
         y = y.reset_index(drop=True).drop('SNP', 1)
         out = pd.concat([x, y], axis=1)
     else:
-        out = pd.merge(x, y, how='inner', on='SNP')
+        ii = None
+        if not (set(x.columns) & set(y.columns)) - set(['SNP']):
+            ii = _snp_index(x_codes, y_codes, n)
+        if ii is not None:
+            jj = np.flatnonzero(ii >= 0)
+            jj = jj[np.argsort(ii[jj], kind='mergesort')]  # order of x, then of y
+            x = x.iloc[ii[jj]].reset_index(drop=True)
+            y = y.iloc[jj].reset_index(drop=True).drop('SNP', 1)
+            out = pd.concat([x, y], axis=1)
+        else:
+            out = pd.merge(x, y, how='inner', on='SNP')
     return out
 
 
-def _read_ref_ld(args, log):
+class _LogBuffer(object):
+    '''Holds the log messages of a reader thread until they can be logged in order.'''
+
+    def __init__(self):
+        self.msgs = []
+
+    def log(self, msg):
+        self.msgs.append(msg)
+
+    def replay(self, log):
+        for msg in self.msgs:
+            log.log(msg)
+
+        self.msgs = []
+
+
+class _Readers(object):
+    '''
+    Reads the inputs of a regression (ref_ld, w_ld, annot) concurrently if --read-threads
+    is greater than one, each parsing its chromosome files in parallel in a shared pool
+    of --read-threads threads.
+
+    start(func, args) returns a function get(log), which returns func(args, log, pool).
+    With --read-threads > 1, func starts running right away in its own thread, its log
+    messages are buffered and get waits for it and then logs them, so that the log reads
+    the same as with sequential reading. Otherwise func runs when get is called.
+
+    '''
+    def __init__(self, args):
+        n = args.read_threads
+        self.pool = ThreadPool(n) if n is not None and n > 1 else None
+        self.threads = ThreadPool(3) if self.pool is not None else None
+
+    def start(self, func, args):
+        if self.threads is None:
+            return lambda log: func(args, log, None)
+
+        buf = _LogBuffer()
+        res = self.threads.apply_async(func, (args, buf, self.pool))
+
+        def get(log):
+            try:
+                return res.get()
+            finally:
+                buf.replay(log)
+
+        return get
+
+    def close(self):
+        for pool in (self.threads, self.pool):
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+
+def _read_ref_ld(args, log, pool=None):
     '''Read reference LD Scores.'''
     ref_ld = _read_chr_split_files(args.ref_ld_chr, args.ref_ld, log,
-                                   'reference panel LD Score', ps.ldscore_fromlist)
+                                   'reference panel LD Score', ps.ldscore_fromlist,
+                                   pool=pool, timed=args.read_threads is not None)
     log.log(
         'Read reference panel LD Scores for {N} SNPs.'.format(N=len(ref_ld)))
     return ref_ld
 
 
-def _read_annot(args, log):
+def _read_ref_ld_M(args, log, pool=None):
+    '''Read reference LD Scores and M.'''
+    ref_ld = _read_ref_ld(args, log, pool)
+    n_annot = len(ref_ld.columns) - 1
+    M_annot = _read_M(args, log, n_annot)
+    return ref_ld, M_annot
+
+
+def _read_annot(args, log, pool=None):
     '''Read annot matrix.'''
+    timed = args.read_threads is not None
     try:
         if args.ref_ld is not None:
             overlap_matrix, M_tot = _read_chr_split_files(args.ref_ld_chr, args.ref_ld, log,
-                                                          'annot matrix', ps.annot, frqfile=args.frqfile)
+                                                          'annot matrix', ps.annot, pool=pool,
+                                                          timed=timed, frqfile=args.frqfile)
         elif args.ref_ld_chr is not None:
             overlap_matrix, M_tot = _read_chr_split_files(args.ref_ld_chr, args.ref_ld, log,
-                                                      'annot matrix', ps.annot, frqfile=args.frqfile_chr)
+                                                      'annot matrix', ps.annot, pool=pool,
+                                                      timed=timed, frqfile=args.frqfile_chr)
     except Exception:
         log.log('Error parsing .annot file.')
         raise
@@ -125,13 +258,14 @@ def _read_M(args, log, n_annot):
     return M_annot
 
 
-def _read_w_ld(args, log):
+def _read_w_ld(args, log, pool=None):
     '''Read regression SNP LD.'''
     if (args.w_ld and ',' in args.w_ld) or (args.w_ld_chr and ',' in args.w_ld_chr):
         raise ValueError(
             '--w-ld must point to a single fileset (no commas allowed).')
     w_ld = _read_chr_split_files(args.w_ld_chr, args.w_ld, log,
-                                 'regression weight LD Score', ps.ldscore_fromlist)
+                                 'regression weight LD Score', ps.ldscore_fromlist,
+                                 pool=pool, timed=args.read_threads is not None)
     if len(w_ld.columns) != 2:
         raise ValueError('--w-ld may only have one LD Score column.')
     w_ld.columns = ['SNP', 'LD_weights']  # prevent colname conflicts w/ ref ld
@@ -140,20 +274,31 @@ def _read_w_ld(args, log):
     return w_ld
 
 
-def _read_chr_split_files(chr_arg, not_chr_arg, log, noun, parsefunc, **kwargs):
-    '''Read files split across 22 chromosomes (annot, ref_ld, w_ld).'''
+def _read_chr_split_files(chr_arg, not_chr_arg, log, noun, parsefunc, pool=None, timed=False,
+                          **kwargs):
+    '''
+    Read files split across 22 chromosomes (annot, ref_ld, w_ld), in parallel if pool is
+    not None. The files are concatenated in chromosome order either way. If timed, logs
+    how long each file took to read.
+
+    '''
+    timings = [] if timed else None
     try:
         if not_chr_arg:
             log.log('Reading {N} from {F} ...'.format(F=not_chr_arg, N=noun))
-            out = parsefunc(_splitp(not_chr_arg), **kwargs)
+            out = parsefunc(_splitp(not_chr_arg), pool=pool, timings=timings, **kwargs)
         elif chr_arg:
             f = ps.sub_chr(chr_arg, '[1-22]')
             log.log('Reading {N} from {F} ...'.format(F=f, N=noun))
-            out = parsefunc(_splitp(chr_arg), _N_CHR, **kwargs)
+            out = parsefunc(_splitp(chr_arg), _N_CHR, pool=pool, timings=timings, **kwargs)
     except ValueError as e:
         log.log('Error parsing {N}.'.format(N=noun))
         raise e
 
+    if timed:
+        for fname, t in timings:
+            log.log('Read {F} in {T:.3f}s.'.format(F=fname, T=t))
+
     return out
 
 
@@ -164,7 +309,9 @@ def _read_sumstats(args, log, fh, alleles=False, dropna=False):
     log_msg = 'Read summary statistics for {N} SNPs.'
     log.log(log_msg.format(N=len(sumstats)))
     m = len(sumstats)
-    sumstats = sumstats.drop_duplicates(subset='SNP')
+    first = np.unique(sumstats.SNP.values.codes, return_index=True)[1]
+    if len(first) < m:  # keep the first row of each SNP
+        sumstats = sumstats.iloc[np.sort(first)]
     if m > len(sumstats):
         log.log(
             'Dropped {M} SNPs with duplicated rs numbers.'.format(M=m - len(sumstats)))
@@ -238,13 +385,42 @@ def _merge_and_log(ld, sumstats, noun, log):
     return sumstats
 
 
-def _read_ld_sumstats(args, log, fh, alleles=False, dropna=True):
-    sumstats = _read_sumstats(args, log, fh, alleles=alleles, dropna=dropna)
-    ref_ld = _read_ref_ld(args, log)
-    n_annot = len(ref_ld.columns) - 1
-    M_annot = _read_M(args, log, n_annot)
+def _read_ld(args, log, readers):
+    '''Read reference LD Scores, M and regression weight LD Scores.'''
+    get_ref_ld = readers.start(_read_ref_ld_M, args)
+    get_w_ld = readers.start(_read_w_ld, args)
+    ref_ld, M_annot = get_ref_ld(log)
     M_annot, ref_ld, novar_cols = _check_variance(log, M_annot, ref_ld)
-    w_ld = _read_w_ld(args, log)
+    w_ld = get_w_ld(log)
+    # the SNPs of the reference LD Scores are the dictionary of the SNP codes of the joins
+    # (see _snp_codes), shared with the weights
+    snps = ref_ld.SNP.values
+    if not isinstance(snps, pd.Categorical):
+        snps = pd.Categorical.from_codes(*pd.factorize(snps))
+    ref_ld['SNP'] = snps
+    w_ld['SNP'] = pd.Categorical.from_codes(_snp_codes(ref_ld, w_ld)[1], snps.categories)
+    return M_annot, ref_ld, novar_cols, w_ld
+
+
+def _read_ld_sumstats(args, log, fh, alleles=False, dropna=True, readers=None, ld=None):
+    '''
+    Read summary statistics and merge them with the LD Scores. ld is the output of
+    _read_ld, which is read here if ld is None.
+
+    '''
+    sumstats = _read_sumstats(args, log, fh, alleles=alleles, dropna=dropna)
+    if ld is None:
+        own_readers = readers is None
+        if own_readers:
+            readers = _Readers(args)
+
+        try:
+            ld = _read_ld(args, log, readers)
+        finally:
+            if own_readers:
+                readers.close()
+
+    M_annot, ref_ld, novar_cols, w_ld = ld
     sumstats = _merge_and_log(ref_ld, sumstats, 'reference panel LD', log)
     sumstats = _merge_and_log(sumstats, w_ld, 'regression SNP LD', log)
     w_ld_cname = sumstats.columns[-1]
@@ -259,52 +435,53 @@ def cell_type_specific(args, log):
     if args.no_intercept:
         args.intercept_h2 = 1
 
-    M_annot_all_regr, w_ld_cname, ref_ld_cnames_all_regr, sumstats, novar_cols = \
-            _read_ld_sumstats(args, log, args.h2_cts)
-    M_tot = np.sum(M_annot_all_regr)
-    _check_ld_condnum(args, log, ref_ld_cnames_all_regr)
-    _warn_length(log, sumstats)
-    n_snp = len(sumstats)
-    n_blocks = min(n_snp, args.n_blocks)
-    if args.chisq_max is None:
-        chisq_max = max(0.001*sumstats.N.max(), 80)
-    else:
-        chisq_max = args.chisq_max
-
-    ii = np.ravel(sumstats.Z**2 < chisq_max)
-    sumstats = sumstats.ix[ii, :]
-    log.log('Removed {M} SNPs with chi^2 > {C} ({N} SNPs remain)'.format(
-            C=chisq_max, N=np.sum(ii), M=n_snp-np.sum(ii)))
-    n_snp = np.sum(ii)  # lambdas are late-binding, so this works
-    ref_ld_all_regr = np.array(sumstats[ref_ld_cnames_all_regr]).reshape((len(sumstats),-1))
-    chisq = np.array(sumstats.Z**2)
-    keep_snps = sumstats[['SNP']]
-
-    s = lambda x: np.array(x).reshape((n_snp, 1))
-    results_columns = ['Name', 'Coefficient', 'Coefficient_std_error', 'Coefficient_P_value']
-    results_data = []
-    for (name, ct_ld_chr) in [x.split() for x in open(args.ref_ld_chr_cts).readlines()]:
-        ref_ld_cts_allsnps = _read_chr_split_files(ct_ld_chr, None, log,
-                                   'cts reference panel LD Score', ps.ldscore_fromlist)
-        log.log('Performing regression.')
-        ref_ld_cts = np.array(pd.merge(keep_snps, ref_ld_cts_allsnps, on='SNP', how='left').ix[:,1:])
-        if np.any(np.isnan(ref_ld_cts)):
-            raise ValueError ('Missing some LD scores from cts files. Are you sure all SNPs in ref-ld-chr are also in ref-ld-chr-cts')
-
-        ref_ld = np.hstack([ref_ld_cts, ref_ld_all_regr])
-        M_cts = ps.M_fromlist(
-                _splitp(ct_ld_chr), _N_CHR, common=(not args.not_M_5_50))
-        M_annot = np.hstack([M_cts, M_annot_all_regr])
-        hsqhat = reg.Hsq(s(chisq), ref_ld, s(sumstats[w_ld_cname]), s(sumstats.N),
-                     M_annot, n_blocks=n_blocks, intercept=args.intercept_h2,
-                     twostep=None, old_weights=True)
-        coef, coef_se = hsqhat.coef[0], hsqhat.coef_se[0]
-        results_data.append((name, coef, coef_se, stats.norm.sf(coef/coef_se)))
-        if args.print_all_cts:
-            for i in range(1, len(ct_ld_chr.split(','))):
-                coef, coef_se = hsqhat.coef[i], hsqhat.coef_se[i]
-                results_data.append((name+'_'+str(i), coef, coef_se, stats.norm.sf(coef/coef_se)))
+    readers = _Readers(args)
+    try:
+        M_annot_all_regr, w_ld_cname, ref_ld_cnames_all_regr, sumstats, novar_cols = \
+                _read_ld_sumstats(args, log, args.h2_cts, readers=readers)
+        M_tot = np.sum(M_annot_all_regr)
+        _check_ld_condnum(args, log, ref_ld_cnames_all_regr)
+        _warn_length(log, sumstats)
+        n_snp = len(sumstats)
+        n_blocks = min(n_snp, args.n_blocks)
+        if args.chisq_max is None:
+            chisq_max = max(0.001*sumstats.N.max(), 80)
+        else:
+            chisq_max = args.chisq_max
 
+        ii = np.ravel(sumstats.Z**2 < chisq_max)
+        sumstats = sumstats.ix[ii, :]
+        log.log('Removed {M} SNPs with chi^2 > {C} ({N} SNPs remain)'.format(
+                C=chisq_max, N=np.sum(ii), M=n_snp-np.sum(ii)))
+        n_snp = np.sum(ii)  # lambdas are late-binding, so this works
+        ref_ld_all_regr = np.array(sumstats[ref_ld_cnames_all_regr]).reshape((len(sumstats),-1))
+        chisq = np.array(sumstats.Z**2)
+        keep_snps = sumstats[['SNP']]
+
+        s = lambda x: np.array(x).reshape((n_snp, 1))
+        results_columns = ['Name', 'Coefficient', 'Coefficient_std_error', 'Coefficient_P_value']
+        results_data = []
+        cell_types = [x.split() for x in open(args.ref_ld_chr_cts).readlines()]
+        state = (args, keep_snps, ref_ld_all_regr, s(chisq), s(sumstats[w_ld_cname]),
+                 s(sumstats.N), M_annot_all_regr, n_blocks)
+        if args.n_workers > 1 and len(cell_types) > 1:
+            log.log('Running the regressions of {N} cell types in {W} processes.'.format(
+                N=len(cell_types), W=args.n_workers))
+            for (name, _), (rows, msgs, error) in zip(cell_types,
+                    parallel.fork_map(_cts_worker, cell_types, args.n_workers, state)):
+                for msg in msgs:
+                    log.log(msg)
+
+                if error is not None:
+                    log.log(error)
+                    raise ValueError('Regression for cell type {N} failed.'.format(N=name))
+
+                results_data.extend(rows)
+        else:
+            for (name, ct_ld_chr) in cell_types:
+                results_data.extend(_cts_regression(log, name, ct_ld_chr, state, readers.pool))
+    finally:
+        readers.close()
 
     df_results = pd.DataFrame(data = results_data, columns = results_columns)
     df_results.sort_values(by = 'Coefficient_P_value', inplace=True)
@@ -312,8 +489,62 @@ def cell_type_specific(args, log):
     log.log('Results printed to '+args.out+'.cell_type_results.txt')
 
 
-def estimate_h2(args, log):
-    '''Estimate h2 and partitioned h2.'''
+def _cts_regression(log, name, ct_ld_chr, state, pool=None):
+    '''
+    Regression for one cell type of --ref-ld-chr-cts, with state the inputs shared by all
+    cell types (see cell_type_specific). Returns rows of the results table.
+
+    '''
+    (args, keep_snps, ref_ld_all_regr, chisq, w_ld, N, M_annot_all_regr, n_blocks) = state
+    start_time = time.time()
+    ref_ld_cts_allsnps = _read_chr_split_files(ct_ld_chr, None, log,
+                               'cts reference panel LD Score', ps.ldscore_fromlist,
+                               pool=pool, timed=args.read_threads is not None)
+    log.log('Performing regression.')
+    ii = _snp_index(*_snp_codes(ref_ld_cts_allsnps, keep_snps))
+    ref_ld_cts = np.array(ref_ld_cts_allsnps.ix[:,1:])[ii]
+    if np.any(ii < 0) or np.any(np.isnan(ref_ld_cts)):
+        raise ValueError ('Missing some LD scores from cts files. Are you sure all SNPs in ref-ld-chr are also in ref-ld-chr-cts')
+
+    ref_ld = np.hstack([ref_ld_cts, ref_ld_all_regr])
+    M_cts = ps.M_fromlist(
+            _splitp(ct_ld_chr), _N_CHR, common=(not args.not_M_5_50))
+    M_annot = np.hstack([M_cts, M_annot_all_regr])
+    hsqhat = reg.Hsq(chisq, ref_ld, w_ld, N,
+                 M_annot, n_blocks=n_blocks, intercept=args.intercept_h2,
+                 twostep=None, old_weights=True)
+    coef, coef_se = hsqhat.coef[0], hsqhat.coef_se[0]
+    rows = [(name, coef, coef_se, stats.norm.sf(coef/coef_se))]
+    if args.print_all_cts:
+        for i in range(1, len(ct_ld_chr.split(','))):
+            coef, coef_se = hsqhat.coef[i], hsqhat.coef_se[i]
+            rows.append((name+'_'+str(i), coef, coef_se, stats.norm.sf(coef/coef_se)))
+
+    log.log('Regression for cell type {N} took {T:.2f}s.'.format(N=name, T=time.time() - start_time))
+    return rows
+
+
+def _cts_worker(cell_type):
+    '''
+    Run _cts_regression in a worker process. Returns (rows, log messages, None), or if it
+    raises, (None, the messages logged until then, the traceback).
+
+    '''
+    name, ct_ld_chr = cell_type
+    buf = _LogBuffer()
+    try:
+        return _cts_regression(buf, name, ct_ld_chr, parallel.state()), buf.msgs, None
+    except Exception:
+        return None, buf.msgs, traceback.format_exc()
+
+
+def estimate_h2(args, log, ld=None, overlap=None, readers=None):
+    '''
+    Estimate h2 and partitioned h2. ld (see _read_ld) and overlap (the annot matrix and
+    M_tot) are read here if None, with readers (see _Readers; e.g., those of a batch) or
+    else their own.
+
+    '''
     args = copy.deepcopy(args)
     if args.samp_prev is not None and args.pop_prev is not None:
         args.samp_prev, args.pop_prev = map(
@@ -322,62 +553,77 @@ def estimate_h2(args, log):
         args.intercept_h2 = float(args.intercept_h2)
     if args.no_intercept:
         args.intercept_h2 = 1
-    M_annot, w_ld_cname, ref_ld_cnames, sumstats, novar_cols = _read_ld_sumstats(
-        args, log, args.h2)
-    ref_ld = np.array(sumstats[ref_ld_cnames])
-    _check_ld_condnum(args, log, ref_ld_cnames)
-    _warn_length(log, sumstats)
-    n_snp = len(sumstats)
-    n_blocks = min(n_snp, args.n_blocks)
-    n_annot = len(ref_ld_cnames)
-    chisq_max = args.chisq_max
-    old_weights = False
-    if n_annot == 1:
-        if args.two_step is None and args.intercept_h2 is None:
-            args.two_step = 30
-    else:
-        old_weights = True
-        if args.chisq_max is None:
-            chisq_max = max(0.001*sumstats.N.max(), 80)
-
-    s = lambda x: np.array(x).reshape((n_snp, 1))
-    chisq = s(sumstats.Z**2)
-    if chisq_max is not None:
-        ii = np.ravel(chisq < chisq_max)
-        sumstats = sumstats.ix[ii, :]
-        log.log('Removed {M} SNPs with chi^2 > {C} ({N} SNPs remain)'.format(
-                C=chisq_max, N=np.sum(ii), M=n_snp-np.sum(ii)))
-        n_snp = np.sum(ii)  # lambdas are late-binding, so this works
-        ref_ld = np.array(sumstats[ref_ld_cnames])
-        chisq = chisq[ii].reshape((n_snp, 1))
-
-    if args.two_step is not None:
-        log.log('Using two-step estimator with cutoff at {M}.'.format(M=args.two_step))
-
-    hsqhat = reg.Hsq(chisq, ref_ld, s(sumstats[w_ld_cname]), s(sumstats.N),
-                     M_annot, n_blocks=n_blocks, intercept=args.intercept_h2,
-                     twostep=args.two_step, old_weights=old_weights)
-
-    if args.print_cov:
-        _print_cov(hsqhat, args.out + '.cov', log)
-    if args.print_delete_vals:
-        _print_delete_values(hsqhat, args.out + '.delete', log)
-        _print_part_delete_values(hsqhat, args.out + '.part_delete', log)
+    own_readers = readers is None
+    if own_readers:
+        readers = _Readers(args)
 
-    log.log(hsqhat.summary(ref_ld_cnames, P=args.samp_prev, K=args.pop_prev, overlap = args.overlap_annot))
-    if args.overlap_annot:
-        overlap_matrix, M_tot = _read_annot(args, log)
+    try:
+        if args.overlap_annot and overlap is None:
+            get_annot = readers.start(_read_annot, args)
 
-        # overlap_matrix = overlap_matrix[np.array(~novar_cols), np.array(~novar_cols)]#np.logical_not
-        df_results = hsqhat._overlap_output(ref_ld_cnames, overlap_matrix, M_annot, M_tot, args.print_coefficients)
-        df_results.to_csv(args.out+'.results', sep="\t", index=False)
-        log.log('Results printed to '+args.out+'.results')
+        M_annot, w_ld_cname, ref_ld_cnames, sumstats, novar_cols = _read_ld_sumstats(
+            args, log, args.h2, readers=readers, ld=ld)
+        ref_ld = np.array(sumstats[ref_ld_cnames])
+        _check_ld_condnum(args, log, ref_ld_cnames)
+        _warn_length(log, sumstats)
+        n_snp = len(sumstats)
+        n_blocks = min(n_snp, args.n_blocks)
+        n_annot = len(ref_ld_cnames)
+        chisq_max = args.chisq_max
+        old_weights = False
+        if n_annot == 1:
+            if args.two_step is None and args.intercept_h2 is None:
+                args.two_step = 30
+        else:
+            old_weights = True
+            if args.chisq_max is None:
+                chisq_max = max(0.001*sumstats.N.max(), 80)
+
+        s = lambda x: np.array(x).reshape((n_snp, 1))
+        chisq = s(sumstats.Z**2)
+        if chisq_max is not None:
+            ii = np.ravel(chisq < chisq_max)
+            sumstats = sumstats.ix[ii, :]
+            log.log('Removed {M} SNPs with chi^2 > {C} ({N} SNPs remain)'.format(
+                    C=chisq_max, N=np.sum(ii), M=n_snp-np.sum(ii)))
+            n_snp = np.sum(ii)  # lambdas are late-binding, so this works
+            ref_ld = np.array(sumstats[ref_ld_cnames])
+            chisq = chisq[ii].reshape((n_snp, 1))
+
+        if args.two_step is not None:
+            log.log('Using two-step estimator with cutoff at {M}.'.format(M=args.two_step))
+
+        hsqhat = reg.Hsq(chisq, ref_ld, s(sumstats[w_ld_cname]), s(sumstats.N),
+                         M_annot, n_blocks=n_blocks, intercept=args.intercept_h2,
+                         twostep=args.two_step, old_weights=old_weights)
+
+        if args.print_cov:
+            _print_cov(hsqhat, args.out + '.cov', log)
+        if args.print_delete_vals:
+            _print_delete_values(hsqhat, args.out + '.delete', log)
+            _print_part_delete_values(hsqhat, args.out + '.part_delete', log)
+
+        log.log(hsqhat.summary(ref_ld_cnames, P=args.samp_prev, K=args.pop_prev, overlap = args.overlap_annot))
+        if args.overlap_annot:
+            overlap_matrix, M_tot = overlap if overlap is not None else get_annot(log)
+
+            # overlap_matrix = overlap_matrix[np.array(~novar_cols), np.array(~novar_cols)]#np.logical_not
+            df_results = hsqhat._overlap_output(ref_ld_cnames, overlap_matrix, M_annot, M_tot, args.print_coefficients)
+            df_results.to_csv(args.out+'.results', sep="\t", index=False)
+            log.log('Results printed to '+args.out+'.results')
+    finally:
+        if own_readers:
+            readers.close()
 
     return hsqhat
 
 
-def estimate_rg(args, log):
-    '''Estimate rg between trait 1 and a list of other traits.'''
+def estimate_rg(args, log, ld=None, readers=None):
+    '''
+    Estimate rg between trait 1 and a list of other traits. ld (see _read_ld) is read here
+    if None, with readers (see _Readers) if not None.
+
+    '''
     args = copy.deepcopy(args)
     rg_paths, rg_files = _parse_rg(args.rg)
     n_pheno = len(rg_paths)
@@ -394,7 +640,8 @@ def estimate_rg(args, log):
     p1 = rg_paths[0]
     out_prefix = args.out + rg_files[0]
     M_annot, w_ld_cname, ref_ld_cnames, sumstats, _ = _read_ld_sumstats(args, log, p1,
-                                                                        alleles=True, dropna=True)
+                                                                        alleles=True, dropna=True,
+                                                                        readers=readers, ld=ld)
     RG = []
     n_annot = M_annot.shape[1]
     if n_annot == 1 and args.two_step is None and args.intercept_h2 is None:
@@ -429,6 +676,315 @@ def estimate_rg(args, log):
     return RG
 
 
+def _read_manifest(fh):
+    '''Read a batch manifest: one entry per line, skipping blank lines and # comments.'''
+    lines = [x.strip() for x in open(fh).readlines()]
+    entries = [x for x in lines if x and not x.startswith('#')]
+    if len(entries) == 0:
+        raise ValueError('No entries in batch manifest {F}.'.format(F=fh))
+
+    return entries
+
+
+def _start_batch(args, log, readers):
+    '''Read the LD Scores (and annot matrix) shared by all traits of a batch with readers.'''
+    get_annot = None
+    if args.h2_batch is not None and args.overlap_annot:
+        get_annot = readers.start(_read_annot, args)
+
+    ld = _read_ld(args, log, readers)
+    overlap = get_annot(log) if get_annot is not None else None
+    return ld, overlap
+
+
+def estimate_h2_batch(args, log):
+    '''
+    Estimate h2 for each .sumstats file listed in --h2-batch, reading the LD Scores, M and
+    annot matrix once. Per-trait output goes to out.<file name>.*, and a table with one
+    row per trait to out.h2_batch.txt.
+
+    '''
+    paths = [_splitp(x)[0] for x in _read_manifest(args.h2_batch)]
+    names = [x.split('/')[-1] for x in paths]
+    if len(set(names)) < len(names):
+        raise ValueError('Files in --h2-batch must have distinct names.')
+
+    log.log('Read {N} traits from batch manifest {F}.'.format(N=len(paths), F=args.h2_batch))
+    readers = _Readers(args)
+    try:
+        ld, overlap = _start_batch(args, log, readers)
+        H2 = []
+        for i, (path, name) in enumerate(zip(paths, names)):
+            log.log('\nEstimating h2 for trait {I}/{N}, from file {F}.'.format(
+                I=i + 1, N=len(paths), F=path))
+            args_i = copy.copy(args)
+            args_i.h2, args_i.out = path, args.out + '.' + name
+            try:
+                H2.append(estimate_h2(args_i, log, ld=ld, overlap=overlap, readers=readers))
+            except Exception:  # keep going if trait 50/100 causes an error
+                log.log('ERROR estimating h2 for trait {I}/{N}, from file {F}.'.format(
+                    I=i + 1, N=len(paths), F=path))
+                log.log(traceback.format_exc() + '\n')
+                H2.append(None)
+    finally:
+        readers.close()
+
+    t = lambda attr: lambda obj: getattr(obj, attr, 'NA')
+    x = pd.DataFrame()
+    x['trait'] = paths
+    if args.samp_prev is not None and args.pop_prev is not None:
+        c = reg.h2_obs_to_liab(1, float(args.samp_prev), float(args.pop_prev))
+        x['h2_liab'] = [c * h.tot if h is not None else 'NA' for h in H2]
+        x['h2_liab_se'] = [c * h.tot_se if h is not None else 'NA' for h in H2]
+    else:
+        x['h2_obs'] = map(t('tot'), H2)
+        x['h2_obs_se'] = map(t('tot_se'), H2)
+
+    x['lambda_gc'] = map(t('lambda_gc'), H2)
+    x['mean_chisq'] = map(t('mean_chisq'), H2)
+    x['intercept'] = map(t('intercept'), H2)
+    x['intercept_se'] = map(t('intercept_se'), H2)
+    x.to_csv(args.out + '.h2_batch.txt', sep='\t', index=False)
+    log.log('\nSummary of heritability results printed to ' + args.out + '.h2_batch.txt')
+    return H2
+
+
+def estimate_rg_batch(args, log):
+    '''
+    Estimate rg for each line of --rg-batch, a comma-separated list of .sumstats files as
+    for --rg, reading the LD Scores and M once. Writes a table with one row per pair to
+    out.rg_batch.txt.
+
+    '''
+    entries = _read_manifest(args.rg_batch)
+    log.log('Read {N} --rg lists from batch manifest {F}.'.format(N=len(entries), F=args.rg_batch))
+    readers = _Readers(args)
+    try:
+        ld, _ = _start_batch(args, log, readers)
+        tables = []
+        for i, rg in enumerate(entries):
+            log.log('\nEstimating rg for list {I}/{N}: {R}.'.format(I=i + 1, N=len(entries), R=rg))
+            args_i = copy.copy(args)
+            args_i.rg = rg
+            rg_paths, _ = _parse_rg(rg)
+            try:
+                RG = estimate_rg(args_i, log, ld=ld, readers=readers)
+            except Exception:  # keep going if list 50/100 causes an error
+                log.log('ERROR estimating rg for list {I}/{N}.'.format(I=i + 1, N=len(entries)))
+                log.log(traceback.format_exc() + '\n')
+                RG = [None for _ in rg_paths[1:]]
+
+            args_i.samp_prev, args_i.pop_prev = map(lambda x: _split_or_none(x, len(rg_paths)),
+                                                    (args.samp_prev, args.pop_prev))
+            tables.append(_rg_table(rg_paths, RG, args_i))
+    finally:
+        readers.close()
+
+    x = pd.concat(tables)
+    x.to_csv(args.out + '.rg_batch.txt', sep='\t', index=False)
+    log.log('\nSummary of genetic correlation results printed to ' + args.out + '.rg_batch.txt')
+    return x
+
+
+def _rg_pair_snps(args, log, x, traits, a, b):
+    '''
+    Mask of the regression SNPs (with LD Scores x) used for the rg of traits a and b: those
+    with matching valid alleles, on which the LD Scores and number of SNPs are checked as in
+    estimate_rg, and with --chisq-max, chi^2 of both traits below it.
+
+    '''
+    (z1, _, c1), (z2, _, c2) = traits[a], traits[b]
+    ii = (c1 >= 0) & (c1 == c2)
+    _check_ld_condnum(args, log, x[ii])
+    _warn_length(log, np.flatnonzero(ii))
+    if args.chisq_max is not None:
+        ii[ii] = z1[ii]**2*z2[ii]**2 < args.chisq_max**2
+
+    return ii
+
+
+def _rg_snp_set(snps):
+    '''Mask of the set of SNPs with key snps (see estimate_rg_matrix).'''
+    args, x, w, M_annot, traits, snp_sets = parallel.state()
+    return np.unpackbits(snp_sets[snps])[:len(w)].astype(bool)
+
+
+def _rg_matrix_hsq(job):
+    '''Fit h2 of trait t on the set of SNPs snps. Returns (Hsq or None, error).'''
+    t, snps = job
+    args, x, w, M_annot, traits, _ = parallel.state()
+    try:
+        ii = _rg_snp_set(snps)
+        z, N, _ = traits[t]
+        n_snp = np.sum(ii)
+        s = lambda y: np.array(y[ii]).reshape((n_snp, 1))
+        hsq = reg.Hsq(np.square(s(z)), x[ii], s(w), s(N), M_annot,
+                      n_blocks=min(args.n_blocks, n_snp), intercept=args.intercept_h2[t],
+                      twostep=args.two_step)
+        return hsq, None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _rg_matrix_rg(job):
+    '''Fit rg of traits a and b on snps given their h2 fits. Returns (RG or None, error).'''
+    a, b, snps, hsq1, hsq2 = job
+    args, x, w, M_annot, traits, _ = parallel.state()
+    try:
+        ii = _rg_snp_set(snps)
+        (z1, N1, _), (z2, N2, _) = traits[a], traits[b]
+        n_snp = np.sum(ii)
+        s = lambda y: np.array(y[ii]).reshape((n_snp, 1))
+        rghat = reg.RG(s(z1), s(z2), x[ii], s(w), s(N1), s(N2), M_annot,
+                       intercept_hsq1=args.intercept_h2[a], intercept_hsq2=args.intercept_h2[b],
+                       intercept_gencov=args.intercept_gencov, n_blocks=min(args.n_blocks, n_snp),
+                       twostep=args.two_step, hsq1=hsq1, hsq2=hsq2)
+        return rghat, None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def estimate_rg_matrix(args, log):
+    '''
+    Estimate rg between every pair of traits in --rg-matrix. Each .sumstats file is read and
+    aligned to the regression SNPs once, h2 is fit once for each trait and set of SNPs
+    (pairs of traits with the same SNPs share it), and the fits run in --n-workers
+    processes. Prints the matrix of rg to out.rg_matrix.txt.
+
+    '''
+    args = copy.deepcopy(args)
+    rg_paths, rg_files = _parse_rg(args.rg_matrix)
+    n_pheno = len(rg_paths)
+    if args.intercept_gencov is not None:
+        raise ValueError('--intercept-gencov cannot be used with --rg-matrix.')
+    if args.no_check_alleles:
+        raise ValueError('--no-check-alleles cannot be used with --rg-matrix.')
+
+    f = lambda x: _split_or_none(x, n_pheno)
+    args.intercept_h2, args.samp_prev, args.pop_prev = map(f,
+        (args.intercept_h2, args.samp_prev, args.pop_prev))
+    map(lambda x: _check_arg_len(x, n_pheno), ((args.intercept_h2, '--intercept-h2'),
+                                               (args.samp_prev, '--samp-prev'),
+                                               (args.pop_prev, '--pop-prev')))
+    if args.no_intercept:
+        args.intercept_h2 = [1 for _ in xrange(n_pheno)]
+        args.intercept_gencov = 0
+
+    readers = _Readers(args)
+    try:
+        M_annot, ref_ld, novar_cols, w_ld = _read_ld(args, log, readers)
+    finally:
+        readers.close()
+    ld = _merge_and_log(ref_ld, w_ld, 'regression SNP LD', log)
+    ref_ld_cnames = ref_ld.columns[1:len(ref_ld.columns)]
+    _check_ld_condnum(args, log, ld[ref_ld_cnames])
+    n_annot = M_annot.shape[1]
+    if n_annot == 1 and args.two_step is None and args.intercept_h2 is None:
+        args.two_step = 30
+    if args.two_step is not None:
+        log.log('Using two-step estimator with cutoff at {M}.'.format(M=args.two_step))
+
+    traits = []
+    for p in rg_paths:
+        # as in --rg, duplicated SNPs are dropped before missing values (a SNP whose first
+        # row has a missing Z or N is not used)
+        sumstats = _read_sumstats(args, log, p, alleles=True, dropna=False)
+        sumstats = sumstats[sumstats.SNP.values.codes >= 0]
+        ii = _snp_index(*_snp_codes(sumstats, ld))  # row of each regression SNP
+        c = (sumstats.A1 + sumstats.A2).map(ALLELE_CLASS)
+        valid = c.notnull().values & sumstats[['Z', 'N']].notnull().all(axis=1).values
+        cls, sign = -np.ones(len(sumstats) + 1, dtype=int), np.ones(len(sumstats) + 1)
+        cls[:-1][valid] = [y[0] for y in c[valid]]
+        sign[:-1][valid] = [y[1] for y in c[valid]]
+        cls, sign = cls[ii], sign[ii]  # row -1 (missing) is the last, invalid one
+        z, N = [np.append(sumstats[k].values, np.nan)[ii] for k in ('Z', 'N')]
+        log.log('{N} regression SNPs with valid alleles in {F}.'.format(N=np.sum(cls >= 0), F=p))
+        traits.append((z * sign, N, cls))
+
+    # the SNPs of each pair, computed once and stored once per distinct set (packed bits)
+    pairs = [(a, b) for a in xrange(n_pheno) for b in xrange(a + 1, n_pheno)]
+    x = np.array(ld[ref_ld_cnames])
+    pair_logs, pair_snps, errors, snp_sets = [], [], [], {}
+    for a, b in pairs:
+        buf = _LogBuffer()
+        try:
+            packed = np.packbits(_rg_pair_snps(args, buf, x, traits, a, b))
+            snps = hashlib.sha1(packed.tostring()).hexdigest()
+            snp_sets.setdefault(snps, packed)
+            pair_snps.append(snps)
+            errors.append(None)
+        except Exception:
+            pair_snps.append(None)
+            errors.append(traceback.format_exc())
+
+        pair_logs.append(buf)
+
+    # the inputs of the fits: args, the reference LD Scores, weights and M of the regression
+    # SNPs, for each trait its Z (aligned to the reference orientation of the alleles), N and
+    # allele class (see ALLELE_CLASS; -1 if the SNP is missing or not a valid SNP), and the
+    # distinct sets of SNPs of the pairs
+    state = (args, x, ld.iloc[:, -1].values, M_annot, traits, snp_sets)
+    pmap = lambda func, jobs: list(parallel.fork_map(func, jobs, args.n_workers, state))
+    # h2 of each trait, once per distinct set of SNPs
+    keys, hsq_jobs = {}, []
+    for (a, b), snps in zip(pairs, pair_snps):
+        for t in (a, b):
+            if snps is not None and (t, snps) not in keys:
+                keys[(t, snps)] = len(hsq_jobs)
+                hsq_jobs.append((t, snps))
+
+    log.log('Computing h2 for {N} trait/SNP set combinations and rg for {P} pairs{W}.'.format(
+        N=len(hsq_jobs), P=len(pairs),
+        W=' in {W} processes'.format(W=args.n_workers) if args.n_workers > 1 else ''))
+    HSQ = pmap(_rg_matrix_hsq, hsq_jobs)
+    rg_jobs = []
+    for i, ((a, b), snps) in enumerate(zip(pairs, pair_snps)):
+        if errors[i] is None:
+            (hsq1, e1), (hsq2, e2) = HSQ[keys[(a, snps)]], HSQ[keys[(b, snps)]]
+            errors[i] = e1 or e2
+            rg_jobs.append((a, b, snps, hsq1, hsq2))
+        else:
+            rg_jobs.append(None)
+
+    RG = pmap(_rg_matrix_rg, [j for j, e in zip(rg_jobs, errors) if e is None])
+    RG.reverse()
+    RG = [(None, e) if e is not None else RG.pop() for e in errors]
+
+    l = lambda x: x + ''.join(['-' for i in range(len(x.replace('\n', '')))])
+    rg_matrix = pd.DataFrame(np.eye(n_pheno), index=rg_paths, columns=rg_paths, dtype=object)
+    rows = []
+    for (a, b), (rghat, e), buf in zip(pairs, RG, pair_logs):
+        log.log(l('\nGenetic correlation of {P1} and {P2}\n'.format(P1=rg_paths[a], P2=rg_paths[b])))
+        buf.replay(log)
+        if rghat is None:
+            log.log('ERROR computing rg of {P1} and {P2}.'.format(P1=rg_paths[a], P2=rg_paths[b]))
+            log.log(e)
+        else:
+            P, K = [args.samp_prev[a], args.samp_prev[b]], [args.pop_prev[a], args.pop_prev[b]]
+            log.log('Heritability of {F}'.format(F=rg_paths[a]))
+            log.log(rghat.hsq1.summary(ref_ld_cnames, P=P[0], K=K[0]))
+            log.log('Heritability of {F}'.format(F=rg_paths[b]))
+            log.log(rghat.hsq2.summary(ref_ld_cnames, P=P[1], K=K[1]))
+            log.log('Genetic Covariance')
+            log.log(rghat.gencov.summary(ref_ld_cnames, P=P, K=K))
+            log.log('Genetic Correlation')
+            log.log(rghat.summary() + '\n')
+
+        rg_matrix.iloc[a, b] = rg_matrix.iloc[b, a] = getattr(rghat, 'rg_ratio', 'NA')
+        rows.append(rghat)
+
+    c = None
+    if args.samp_prev is not None and args.pop_prev is not None and \
+            all(y is not None for y in args.samp_prev + args.pop_prev):
+        c = [reg.h2_obs_to_liab(1, args.samp_prev[b], args.pop_prev[b]) for a, b in pairs]
+
+    x = _rg_rows([rg_paths[a] for a, b in pairs], [rg_paths[b] for a, b in pairs], rows, c)
+    log.log('\nSummary of Genetic Correlation Results\n' + x.to_string(header=True, index=False) + '\n')
+    rg_matrix.to_csv(args.out + '.rg_matrix.txt', sep='\t', index_label='trait')
+    log.log('Matrix of genetic correlations printed to ' + args.out + '.rg_matrix.txt')
+    return rg_matrix
+
+
 def _read_other_sumstats(args, log, p2, sumstats, ref_ld_cnames):
     loop = _read_sumstats(args, log, p2, alleles=True, dropna=False)
     loop = _merge_sumstats_sumstats(args, sumstats, loop, log)
@@ -447,20 +1003,37 @@ def _read_other_sumstats(args, log, p2, sumstats, ref_ld_cnames):
 
 def _get_rg_table(rg_paths, RG, args):
     '''Print a table of genetic correlations.'''
+    return _rg_table(rg_paths, RG, args).to_string(header=True, index=False) + '\n'
+
+
+def _rg_table(rg_paths, RG, args):
+    '''Table of genetic correlations.'''
+    c = None
+    if args.samp_prev is not None and args.pop_prev is not None and\
+            all((i is not None for i in args.samp_prev)) and all((i is not None for i in args.pop_prev)):
+        c = [reg.h2_obs_to_liab(1, args.samp_prev[1], args.pop_prev[1])] * len(RG)
+
+    return _rg_rows([rg_paths[0]] * len(RG), rg_paths[1:len(rg_paths)], RG, c)
+
+
+def _rg_rows(p1, p2, RG, c=None):
+    '''
+    Table of the genetic correlations RG of traits p1[i] and p2[i], with the h2 of p2[i] on
+    the liability scale (times c[i]) if c is not None.
+
+    '''
     t = lambda attr: lambda obj: getattr(obj, attr, 'NA')
     x = pd.DataFrame()
-    x['p1'] = [rg_paths[0] for i in xrange(1, len(rg_paths))]
-    x['p2'] = rg_paths[1:len(rg_paths)]
+    x['p1'] = p1
+    x['p2'] = p2
     x['rg'] = map(t('rg_ratio'), RG)
     x['se'] = map(t('rg_se'), RG)
     x['z'] = map(t('z'), RG)
     x['p'] = map(t('p'), RG)
-    if args.samp_prev is not None and args.pop_prev is not None and\
-            all((i is not None for i in args.samp_prev)) and all((i is not None for it in args.pop_prev)):
-        c = reg.h2_obs_to_liab(1, args.samp_prev[1], args.pop_prev[1])
-        x['h2_liab'] = map(lambda x: c * x, map(t('tot'), map(t('hsq2'), RG)))
-        x['h2_liab_se'] = map(
-            lambda x: c * x, map(t('tot_se'), map(t('hsq2'), RG)))
+    if c is not None:
+        liab = lambda k, y: y if isinstance(y, str) else k * y
+        x['h2_liab'] = map(liab, c, map(t('tot'), map(t('hsq2'), RG)))
+        x['h2_liab_se'] = map(liab, c, map(t('tot_se'), map(t('hsq2'), RG)))
     else:
         x['h2_obs'] = map(t('tot'), map(t('hsq2'), RG))
         x['h2_obs_se'] = map(t('tot_se'), map(t('hsq2'), RG))
@@ -469,7 +1042,7 @@ def _get_rg_table(rg_paths, RG, args):
     x['h2_int_se'] = map(t('intercept_se'), map(t('hsq2'), RG))
     x['gcov_int'] = map(t('intercept'), map(t('gencov'), RG))
     x['gcov_int_se'] = map(t('intercept_se'), map(t('gencov'), RG))
-    return x.to_string(header=True, index=False) + '\n'
+    return x
 
 
 def _print_gencor(args, log, rghat, ref_ld_cnames, i, rg_paths, print_hsq1):